@@ -1,28 +1,237 @@
 import ast
+from bisect import bisect_right
+from functools import lru_cache
 
 
 def print_ast(node):
-    def __print__(node, path):
-        if len(path) > 0:
-            print(path[-1])
-        path_from_parent = path[-1] if len(path) > 0 else []
-        return "{}{} ({})".format(
-            " " * len(path),
-            node.__class__.__name__,
-            ".".join(map(str, path_from_parent)))
-    return "\n".join([__print__(node, path) for node, path in visit_ast(node)])
+    """one line per node: its class name indented by depth and the path from
+    its parent"""
+    return "\n".join(
+        "{}{} ({})".format(" " * len(path),
+                           node.__class__.__name__,
+                           ".".join(map(str, path[-1] if path else [])))
+        for node, path in walk_ast(node))
 
 
-def visit_ast(node, path=[]):
-    """simple linear generator for nodes and their path"""
-    yield (node, path)
+def child_steps(node):
+    """(step, child) for the child nodes of node, step is [field] or [field, index]"""
     for field, value in ast.iter_fields(node):
         if isinstance(value, list):
             for n, item in enumerate(value):
                 if isinstance(item, ast.AST):
-                    yield from visit_ast(item, path + [[field, n]])
+                    yield [field, n], item
         elif isinstance(value, ast.AST):
-            yield from visit_ast(value, path + [[field]])
+            yield [field], value
+
+
+def walk_ast(node):
+    """Yields (node, path) depth first like visit_ast, without recursion. path
+    is one list that is updated in place while walking, copy it to keep it."""
+    path = []
+    yield node, path
+    stack = [child_steps(node)]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+            if stack:
+                path.pop()
+            continue
+        step, child = entry
+        path.append(step)
+        yield child, path
+        stack.append(child_steps(child))
+
+
+def visit_ast(node, path=[]):
+    """simple linear generator for nodes and their path"""
+    for child, child_path in walk_ast(node):
+        yield (child, path + child_path)
+
+
+def has_toplevel_await(node):
+    """True if node contains await, async for or async with outside of a nested
+    function, i.e. if it can only run inside a coroutine."""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (ast.Await, ast.AsyncFor, ast.AsyncWith)):
+            return True
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            stack.extend(node.decorator_list)
+            stack.append(node.args)
+            continue
+        if isinstance(node, ast.Lambda):
+            stack.append(node.args)
+            continue
+        stack.extend(ast.iter_child_nodes(node))
+    return False
+
+
+_comprehensions = (ast.ListComp, ast.SetComp, ast.DictComp, ast.GeneratorExp)
+_definitions = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)
+
+def own_bound_names(node, in_comprehension=False):
+    """names node binds by itself, not counting its children"""
+    if isinstance(node, ast.NamedExpr):
+        return [node.target.id]
+    if isinstance(node, ast.Name):
+        bound = not in_comprehension and isinstance(node.ctx, (ast.Store, ast.Del))
+        return [node.id] if bound else []
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return [node.name]
+    if isinstance(node, (ast.Import, ast.ImportFrom)):
+        return [(alias.asname or alias.name).split(".")[0]
+                for alias in node.names if alias.name != "*"]
+    if isinstance(node, ast.ExceptHandler) or type(node).__name__ in ("MatchAs", "MatchStar"):
+        return [node.name] if node.name else []
+    return []
+
+
+def outer_scope_children(node):
+    """the children of a function, class or lambda that are evaluated in the
+    scope around it"""
+    if isinstance(node, ast.Lambda):
+        return []
+    if isinstance(node, ast.ClassDef):
+        return node.decorator_list + node.bases
+    return node.decorator_list + [node.args]
+
+
+def bound_names(node):
+    """names that node binds in the scope it appears in. Bodies of nested
+    functions and classes and comprehension variables are not included."""
+    names = set()
+    stack = [(node, False)]
+    while stack:
+        node, in_comprehension = stack.pop()
+        names.update(own_bound_names(node, in_comprehension))
+        if isinstance(node, _definitions):
+            children = outer_scope_children(node)
+        else:
+            children = ast.iter_child_nodes(node)
+            in_comprehension = in_comprehension or isinstance(node, _comprehensions)
+        stack.extend((ea, in_comprehension) for ea in children)
+    return names
+
+
+def referenced_names(node):
+    """names read anywhere inside node, including nested function bodies"""
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Name) and isinstance(child.ctx, ast.Load):
+            names.add(child.id)
+        elif isinstance(child, ast.AugAssign) and isinstance(child.target, ast.Name):
+            names.add(child.target.id)
+    return names
+
+
+def late_bound_names(node):
+    """names read in the bodies of the functions, lambdas and classes inside
+    node, they are looked up when the body runs and not when node runs"""
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, _definitions):
+            body = child.body if isinstance(child.body, list) else [child.body]
+            for ea in body:
+                names.update(referenced_names(ea))
+    return names
+
+
+def toplevel_statements(source):
+    """returns a list of (node, source_of_node) for the top-level statements of
+    source. Decorators are part of the statement source."""
+    lines = [line.encode("utf-8") for line in source.splitlines(True)]
+    statements = []
+    for node in ast.parse(source).body:
+        decorators = getattr(node, "decorator_list", [])
+        # decorators start a line, their col_offset is behind the @
+        start_line = min([node.lineno] + [ea.lineno for ea in decorators])
+        start_col = 0 if decorators else node.col_offset
+        if start_line == node.end_lineno:
+            segment = lines[start_line - 1][start_col:node.end_col_offset]
+        else:
+            first = lines[start_line - 1][start_col:]
+            last = lines[node.end_lineno - 1][:node.end_col_offset]
+            segment = b"".join([first, *lines[start_line:node.end_lineno - 1], last])
+        statements.append((node, segment.decode("utf-8")))
+    return statements
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+# position index
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+class PositionIndex(object):
+    """Finds the innermost node at a (line, column) of source. Lines are 1-based,
+    columns 0-based characters (not the utf-8 byte offsets of ast). Nodes are
+    sorted by start position, a lookup bisects to the last node starting at or
+    before the position and goes up its parents to the first that contains it
+    (end positions count as inside)."""
+
+    def __init__(self, source):
+        self.source = source
+        self.lines = source.splitlines(True)
+        self.tree = ast.parse(source)
+        entries = []
+        parents = {}
+        for node, path in walk_ast(self.tree):
+            for child in ast.iter_child_nodes(node):
+                parents[child] = node
+            if hasattr(node, "lineno") and getattr(node, "end_lineno", None) is not None:
+                start = (node.lineno, node.col_offset)
+                end = (node.end_lineno, node.end_col_offset)
+                # outer nodes first when they start at the same position
+                entries.append((start, (-end[0], -end[1]), len(entries), node))
+        entries.sort()
+        self.starts = [start for start, _, _, _ in entries]
+        self.nodes = [node for _, _, _, node in entries]
+        self.parents = parents
+
+    def byte_offset(self, line, column):
+        if 0 < line <= len(self.lines):
+            return len(self.lines[line - 1][:column].encode("utf-8"))
+        return column
+
+    def contains(self, node, position):
+        start = (node.lineno, node.col_offset)
+        end = (node.end_lineno, node.end_col_offset)
+        return start <= position <= end
+
+    def node_at(self, line, column, types=None):
+        """innermost node at line / column, optionally the innermost that is an
+        instance of types. None if there is none."""
+        position = (line, self.byte_offset(line, column))
+        i = bisect_right(self.starts, position) - 1
+        if i < 0:
+            return None
+        node = self.nodes[i]
+        while node is not None:
+            if hasattr(node, "lineno") and self.contains(node, position) and (
+                    types is None or isinstance(node, types)):
+                return node
+            node = self.parents.get(node)
+        return None
+
+    def segment(self, node):
+        return ast.get_source_segment(self.source, node)
+
+
+@lru_cache(maxsize=32)
+def position_index(source):
+    """cached PositionIndex of source"""
+    return PositionIndex(source)
+
+
+def expression_at(source, line, column):
+    """source of the innermost expression at line / column, None if there is
+    none or source does not parse"""
+    try:
+        index = position_index(source)
+    except SyntaxError:
+        return None
+    node = index.node_at(line, column, ast.expr)
+    return index.segment(node) if node else None
 
 
 # import astor
@@ -1,11 +1,146 @@
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from yapf.yapflib import style
 from yapf.yapflib.yapf_api import FormatCode
+from lively import executors
 
 # see https://github.com/google/yapf
 
+# style config (name, file name or dict) -> yapf style dict, per process
+styles = OrderedDict()
+max_styles = 32
+
+
+def style_key(config):
+    return config if config is None or isinstance(config, str) else json.dumps(config, sort_keys=True)
+
+
+def style_for(config):
+    """yapf style dict for config, created once per config"""
+    key = style_key(config)
+    if key in styles:
+        styles.move_to_end(key)
+        return styles[key]
+    if config is None:
+        # yapf would resolve None to the global style that code_format changes
+        created = style.DEFAULT_STYLE_FACTORY()
+    else:
+        created = style.CreateStyleFromConfig(config)
+    styles[key] = created
+    while len(styles) > max_styles:
+        styles.popitem(last=False)
+    return created
+
 
 def code_format(source, lines=None, file="<formatted>", config=None):
+    # FormatCode would parse config again; with style_config=None it uses the
+    # global style
+    style.SetGlobalStyle(style_for(config))
     formatted_code, success = FormatCode(source,
                                          filename=file,
-                                         style_config=config,
+                                         style_config=None,
                                          lines=lines)
     return formatted_code
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+# cached formatting off the event loop
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+class FormatCache(object):
+    """LRU of formatted sources keyed by a hash of (source, lines, style)"""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(source, lines, config):
+        lines = [list(ea) for ea in lines] if lines else None
+        data = json.dumps([source, lines, style_key(config)])
+        return hashlib.sha1(data.encode("utf-8", "surrogatepass")).hexdigest()
+
+    def get(self, key):
+        formatted = self.entries.get(key)
+        if formatted is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return formatted
+
+    def put(self, key, formatted):
+        self.entries[key] = formatted
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+format_cache = FormatCache()
+
+# cache key -> future of a format running for it, identical requests share it
+pending_formats = {}
+
+
+async def run_code_format(source, lines=None, file="<formatted>", config=None, executor="format"):
+    """Like code_format but in the pool executor (see lively.executors) and with
+    results cached in format_cache. Returns {formatted, cached, time}, time is
+    the seconds spent formatting (0 for cache hits)."""
+    start = time.perf_counter()
+    key = format_cache.key(source, lines, config)
+    formatted = format_cache.get(key)
+    if formatted is not None:
+        return {"formatted": formatted, "cached": True, "time": 0}
+    future = pending_formats.get(key)
+    if future is None:
+        loop = asyncio.get_event_loop()
+        future = pending_formats[key] = loop.run_in_executor(
+            executors.get_executor(executor), code_format, source, lines, file, config)
+        future.add_done_callback(lambda _: pending_formats.pop(key, None))
+    formatted = await asyncio.shield(future)
+    format_cache.put(key, formatted)
+    return {"formatted": formatted, "cached": False, "time": time.perf_counter() - start}
+
+
+def batch_entry(entry):
+    """{file, source, lines, style} from a dict or a (file, source, lines, style) sequence"""
+    if isinstance(entry, dict):
+        return entry
+    if not isinstance(entry, (list, tuple)):
+        raise ValueError("entry should be a dict or a list, got {}".format(type(entry).__name__))
+    return dict(zip(("file", "source", "lines", "style"), entry))
+
+
+async def code_format_batch(entries, executor="format"):
+    """Formats entries (see batch_entry) in parallel and yields the results as
+    they finish, as {index, file, formatted, cached, time} or {index, file,
+    error} for entries that failed."""
+    async def format_entry(index, entry):
+        file = "<unknown>"
+        try:
+            entry = batch_entry(entry)
+            file = entry.get("file") or file
+            if not isinstance(entry.get("source"), str):
+                raise ValueError("needs source")
+            result = await run_code_format(entry["source"], entry.get("lines"), file,
+                                           entry.get("style"), executor)
+        except Exception as err:
+            return {"index": index, "file": file, "error": str(err)}
+        return {"index": index, "file": file, **result}
+
+    tasks = [asyncio.ensure_future(format_entry(i, ea))
+             for i, ea in enumerate(entries)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
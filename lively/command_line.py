@@ -3,13 +3,24 @@
 import argparse
 import asyncio
 from lively.ws_server import (start, default_host, default_port)
+from lively.sessions import SessionManager
+
+def module_list(names):
+    return [name.strip() for name in names.split(",") if name.strip()]
 
 def main():
     parser = argparse.ArgumentParser(description='Starts a websocket or epc server for eval requests')
-    parser.add_argument('--hostname', dest="hostname", type=str, default=default_host, help='hostname, defaults to '.format(default_host))
-    parser.add_argument('--hostname', dest="hostname", type=str, default=default_host, help='hostname, defaults to '.format(default_host))
+    parser.add_argument('--hostname', dest="hostname", type=str, default=default_host, help='hostname, defaults to {}'.format(default_host))
     parser.add_argument('--port', dest="port", type=int, default=default_port, help='port, defaults to {}'.format(default_port))
+    parser.add_argument('--sessions', dest="sessions", type=int, default=0, help='run each connection in its own worker process, keeping that many workers pre-started')
+    parser.add_argument('--preload', dest="preload", type=str, default="", help='comma separated modules that session workers import on start')
+    parser.add_argument('--preload-completions', dest="preload_completions", type=str, default="", help='comma separated modules that jedi parses on start')
+    parser.add_argument('--metrics-port', dest="metrics_port", type=int, default=None, help='serve Prometheus metrics on http://{}:METRICS_PORT/metrics'.format(default_host))
     args = parser.parse_args()
+    sessions = None
+    if args.sessions > 0:
+        sessions = SessionManager(args.sessions, module_list(args.preload))
     loop = asyncio.get_event_loop()
-    start(args.hostname, args.port, loop)
+    start(args.hostname, args.port, loop, sessions, module_list(args.preload_completions),
+          metrics_port=args.metrics_port)
     loop.run_forever()
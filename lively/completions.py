@@ -1,28 +1,262 @@
+import os
+import re
+import sys
+import heapq
+import asyncio
 import inspect
+import builtins
+from collections import OrderedDict
 import jedi
-from lively.eval import run_eval
+from lively.eval import run_eval, namespace_versions
+from lively import executors
+from lively.name_index import name_index
 
-async def get_completions(source, row, column, file="<completions>"):
+# jedi < 0.16 only has Script(source, line, column, path).completions()
+legacy_jedi = not hasattr(jedi.Script, "complete")
+
+
+class JediFileState(object):
+
+    def __init__(self, source, script):
+        self.source = source
+        self.script = script
+
+
+class JediCache(object):
+    """Keeps jedi state between completion requests: one jedi Project per
+    directory, a shared environment and, per file, the Script of the last source
+    seen. Requests for an unchanged buffer reuse that Script and the inference
+    it has done, changed buffers get a new Script with the same project and
+    environment (and parso re-parses incrementally, keyed by path). At most
+    max_files files with max_source_size characters of source in total are
+    kept, least recently used first out."""
+
+    def __init__(self, max_files=20, max_source_size=5 * 1024 * 1024):
+        self.max_files = max_files
+        self.max_source_size = max_source_size
+        self.files = OrderedDict()
+        self.projects = {}
+        self.environment = None
+        self.source_size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def project_for(self, file):
+        directory = os.path.dirname(os.path.abspath(file)) if file else os.getcwd()
+        project = self.projects.get(directory)
+        if not project:
+            project = self.projects[directory] = jedi.Project(directory)
+        return project
+
+    def script(self, source, file):
+        state = self.files.get(file)
+        if state and state.source == source:
+            self.hits += 1
+            self.files.move_to_end(file)
+            return state.script
+        self.misses += 1
+        if not self.environment:
+            self.environment = jedi.InterpreterEnvironment()
+        script = jedi.Script(source, path=file, project=self.project_for(file),
+                             environment=self.environment)
+        self.forget(file)
+        self.files[file] = JediFileState(source, script)
+        self.source_size += len(source)
+        while len(self.files) > 1 and self.over_budget():
+            self.forget(next(iter(self.files)))
+        return script
+
+    def over_budget(self):
+        return len(self.files) > self.max_files or self.source_size > self.max_source_size
+
+    def forget(self, file):
+        state = self.files.pop(file, None)
+        if state:
+            self.source_size -= len(state.source)
+
+    def clear(self):
+        self.files.clear()
+        self.projects.clear()
+        self.source_size = 0
+
+
+jedi_cache = JediCache()
+
+
+def jedi_completions(source, row, column, file, fuzzy=False):
+    if legacy_jedi:
+        return jedi.Script(source, row, column, file).completions()
+    return jedi_cache.script(source, file).complete(row, column, fuzzy=fuzzy)
+
+
+def completion_params(compl):
+    if legacy_jedi:
+        return compl.params
+    signatures = compl.get_signatures()
+    return signatures[0].params if signatures else []
+
+
+def prewarm_completions(module_names):
+    """Let jedi parse and cache module_names, e.g. heavy imports that users
+    will complete on"""
+    jedi.preload_module(*module_names)
+
+
+compl_attrs = ["module_name", "module_path", "is_keyword", "type", "name", "full_name"]
+
+
+def completion_signature(compl):
+    return "({})".format(",".join([p.name for p in completion_params(compl)]))
+
+
+def get_jedi_completions(source, row, column, file, ranked=False, limit=None, signatures=True):
+    """ranked: fuzzy match and order by rank_completions, limit: return only the
+    best limit completions, signatures: append the parameters to function names
+    (looking them up is the expensive part, only done for the completions returned)"""
+    completions = jedi_completions(source, row, column, file, fuzzy=ranked and not legacy_jedi)
+    if ranked:
+        completions = rank_completions(
+            completions, typed_prefix(source, row, column), limit, key=lambda c: c.name)
+    elif limit is not None:
+        completions = completions[:limit]
     compl_data = []
+    counter = 0
+    for compl in completions:
+        data = {name: getattr(compl, name) for name in compl_attrs}
+        if data["module_path"] is not None:
+            data["module_path"] = str(data["module_path"])
+        data['priority'] = 1000 - counter
+        counter = counter + 1
+        if signatures and compl.type == "function":
+            data['name'] += completion_signature(compl)
+        compl_data.append(data)
+    return compl_data
+
+
+# answer bare identifiers and "import x" from lively.name_index instead of jedi
+use_name_index = True
+
+import_context_re = re.compile(r"^\s*(?:import|from)\s+([A-Za-z_][A-Za-z0-9_]*)$")
+identifier_context_re = re.compile(r"(?:^|[^\w.])([A-Za-z_][A-Za-z0-9_]*)$")
+definition_context_re = re.compile(r"^\s*(?:async\s+)?(?:def|class|from)\s")
 
-    # try jedi
-    script = jedi.Script(source, row, column, file)
-    completions = script.completions()
-    if (len(completions) > 0):
-        compl_attrs = ["module_name", "module_path", "is_keyword", "type", "name", "full_name"]
-        counter = 0
-        for compl in completions:
-            data = {name: getattr(compl, name) for name in compl_attrs}
-            data['priority'] = 1000 - counter
-            counter = counter + 1
-            if compl.type == "function":
-                signature = "({})".format(",".join([p.name for p in compl.params]))
-                data['name'] += signature
-            compl_data.append(data)
+
+def index_completion_context(source, row, column):
+    """("module" | "identifier", prefix) if the cursor is behind a word that the
+    name index can complete, None for contexts that need jedi (attributes,
+    strings, comments, names being defined, from imports)"""
+    lines = source.splitlines()
+    if not 0 < row <= len(lines):
+        return None
+    line = lines[row - 1][:column]
+    if "#" in line or line.count('"') % 2 or line.count("'") % 2:
+        return None
+    match = import_context_re.match(line)
+    if match:
+        return ("module", match.group(1))
+    if definition_context_re.match(line) or re.match(r"^\s*import\s", line):
+        return None
+    match = identifier_context_re.search(line)
+    if match:
+        return ("identifier", match.group(1))
+    return None
+
+
+def index_signature(name, module_name):
+    module = sys.modules.get(module_name or "__main__")
+    namespace = module.__dict__ if module else {}
+    value = namespace[name] if name in namespace else getattr(builtins, name, None)
+    try:
+        return "({})".format(",".join(inspect.signature(value).parameters))
+    except (TypeError, ValueError):
+        return "()"
+
+
+def get_index_completions(source, row, column, module_name=None,
+                          ranked=False, limit=None, signatures=True):
+    """completions from lively.name_index, None if the context at row / column
+    is not one the index answers"""
+    context = index_completion_context(source, row, column)
+    if not context:
+        return None
+    kind, prefix = context
+    if kind == "module":
+        names = name_index.module_completions(prefix)
+    else:
+        # the word being typed is in the buffer, don't offer it as its own completion
+        names = [(name, type) for name, type in
+                 name_index.identifier_completions(prefix, module_name, source)
+                 if name != prefix or type != "statement"]
+    if ranked:
+        names = rank_completions(names, prefix, limit, key=lambda n: n[0])
+    elif limit is not None:
+        names = names[:limit]
+    compl_data = []
+    for counter, (name, type) in enumerate(names):
+        display_name = name
+        if signatures and type == "function":
+            display_name += index_signature(name, module_name)
+        compl_data.append({
+            "name": display_name, "type": type, "full_name": name,
+            "module_name": None, "module_path": None,
+            "is_keyword": type == "keyword",
+            "priority": 1000 - counter
+        })
+    return compl_data
+
+
+def get_static_completions(source, row, column, file, module_name=None,
+                           ranked=False, limit=None, signatures=True):
+    if use_name_index:
+        compl_data = get_index_completions(source, row, column, module_name,
+                                           ranked, limit, signatures)
+        if compl_data:
+            return compl_data
+    return get_jedi_completions(source, row, column, file, ranked, limit, signatures)
+
+
+async def get_completions(source, row, column, file="<completions>",
+                          module_name=None, resolve_attributes=None,
+                          ranked=False, limit=None, signatures=True):
+    """Completions for source at row / column. If jedi finds nothing the
+    expression in front of the cursor is looked up in module_name (with getattr
+    for plain attribute chains unless resolve_attributes is False, otherwise
+    evaluated) and its attributes are listed. ranked, limit and signatures are
+    explained in get_jedi_completions."""
+    # try the name index and jedi, in the "completion" pool since it is CPU bound
+    loop = asyncio.get_event_loop()
+    compl_data = await loop.run_in_executor(
+        executors.get_executor("completion"),
+        get_static_completions, source, row, column, file, module_name,
+        ranked, limit, signatures)
+    if (len(compl_data) > 0):
         return compl_data
 
 
     # try to eval code snippet in front of column and dynamically use dir() on eval result
+    expr, prefix = completion_target(source, row, column)
+    try:
+        obj = await evaluate_completion_target(expr, module_name, resolve_attributes)
+    except LookupError:
+        return []
+
+    members = member_cache.members(obj)
+    if ranked:
+        members = rank_completions(members, prefix, limit, key=lambda m: m[0])
+    else:
+        members = [m for m in members if not prefix or m[0].startswith(prefix)][:limit]
+    for key, type, name in members:
+        compl_data.append({
+            "name": name if signatures else key, "type": type,
+            "module_name": expr, "prefix": prefix,
+            "priority": 1000
+        })
+    return compl_data
+
+
+def completion_target(source, row, column):
+    """splits the word in front of row / column into the expression completed
+    on and the typed prefix: "foo.bar.ba" -> ("foo.bar", "ba")"""
     line = source.splitlines()[row - 1][:column]
     *_, expr = line.split(" ")
     prefix = ""
@@ -31,27 +265,220 @@ async def get_completions(source, row, column, file="<completions>"):
     elif "." in expr:
         *front_parts, prefix = expr.split(".")
         expr = ".".join(front_parts)
+    return expr, prefix
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+# ranking and payloads
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+typed_prefix_re = re.compile(r"[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def typed_prefix(source, row, column):
+    lines = source.splitlines()
+    line = lines[row - 1][:column] if 0 < row <= len(lines) else ""
+    match = typed_prefix_re.search(line)
+    return match.group(0) if match else ""
 
-    result = await run_eval(expr)
-    if result.is_error:
-        return []
 
-    for key in dir(result.value):
-        if len(prefix) > 0 and not key.startswith(prefix):
+def fuzzy_score(name, prefix):
+    """Sort key for name when prefix was typed, lower is better. None if the
+    characters of prefix do not appear in name in order (ignoring case). Exact
+    prefixes come first, then prefixes in other case, then fuzzy matches with
+    the fewest gaps; private names after public ones, shorter names first."""
+    private = name.startswith("_") and not prefix.startswith("_")
+    if name.startswith(prefix):
+        kind, gaps = 0, 0
+    elif name.lower().startswith(prefix.lower()):
+        kind, gaps = 1, 0
+    else:
+        lower_name, gaps, pos = name.lower(), 0, -1
+        for char in prefix.lower():
+            found = lower_name.find(char, pos + 1)
+            if found == -1:
+                return None
+            gaps += found - pos - 1
+            pos = found
+        kind = 2
+    return (private, kind, gaps, len(name))
+
+
+def rank_completions(items, prefix, limit=None, key=lambda name: name):
+    """the items matching prefix, best first by fuzzy_score of key(item). With
+    limit only the limit best are returned."""
+    scored = []
+    for i, item in enumerate(items):
+        score = fuzzy_score(key(item), prefix)
+        if score is not None:
+            scored.append((score, i, item))
+    best = heapq.nsmallest(limit, scored) if limit is not None else sorted(scored)
+    return [item for _, _, item in best]
+
+
+def completions_as_columns(completions):
+    """Compact form of a list of completion dicts: one list per attribute
+    instead of one dict per completion, module paths are sent once in
+    "modulePaths" and referenced by index.
+    {"columns": [name, ...], "rows": n, "name": [...], "module_path": [0, 0, ...],
+     "modulePaths": [path, ...], ...}"""
+    columns = []
+    for compl in completions:
+        columns.extend(key for key in compl if key not in columns)
+    payload = {"columns": columns, "rows": len(completions)}
+    paths = {}
+    for column in columns:
+        values = [compl.get(column) for compl in completions]
+        if column == "module_path":
+            values = [None if path is None else paths.setdefault(path, len(paths))
+                      for path in values]
+        payload[column] = values
+    payload["modulePaths"] = list(paths)
+    return payload
+
+
+async def get_completion_details(source, row, column, name, file="<completions>",
+                                 module_name=None, resolve_attributes=None):
+    """signature and docstring of the completion name at row / column, to be
+    fetched once the user selects an entry. None if name is not found."""
+    loop = asyncio.get_event_loop()
+    details = await loop.run_in_executor(
+        executors.get_executor("completion"),
+        get_jedi_completion_details, source, row, column, name, file)
+    if details:
+        return details
+
+    expr, _ = completion_target(source, row, column)
+    try:
+        obj = await evaluate_completion_target(expr, module_name, resolve_attributes)
+        val = getattr(obj, name)
+    except Exception:
+        return None
+    description = describe_member(obj, name)
+    return {
+        "name": name,
+        "type": description[0] if description else "instance",
+        "signature": (description[1][len(name):]
+                      if description and description[0] == "function" else None),
+        "doc": (inspect.getdoc(val) or "") if callable(val) else ""
+    }
+
+
+def get_jedi_completion_details(source, row, column, name, file):
+    for compl in jedi_completions(source, row, column, file):
+        if compl.name != name:
             continue
+        return {
+            "name": compl.name,
+            "type": compl.type,
+            "full_name": compl.full_name,
+            "signature": completion_signature(compl) if compl.type == "function" else None,
+            "doc": compl.docstring(raw=True)
+        }
+    return None
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+# runtime introspection for the completion fallback
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+# resolve expressions like "foo.bar.baz" with getattr instead of evaluating them
+resolve_attributes_without_eval = True
+
+attribute_chain_re = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+
+def resolve_attribute_chain(expr, module_name=None):
+    """looks up a dotted name in the module namespace and builtins, raises
+    LookupError if that is not possible"""
+    module = sys.modules.get(module_name or "__main__")
+    first, *rest = expr.split(".")
+    namespace = module.__dict__ if module else {}
+    if first in namespace:
+        obj = namespace[first]
+    elif hasattr(builtins, first):
+        obj = getattr(builtins, first)
+    else:
+        raise LookupError(first)
+    try:
+        for name in rest:
+            obj = getattr(obj, name)
+    except Exception as err:
+        raise LookupError(expr) from err
+    return obj
+
+
+async def evaluate_completion_target(expr, module_name=None, resolve_attributes=None):
+    if resolve_attributes is None:
+        resolve_attributes = resolve_attributes_without_eval
+    if resolve_attributes and attribute_chain_re.match(expr):
+        return resolve_attribute_chain(expr, module_name)
+    result = await run_eval(expr, module_name)
+    if result.is_error:
+        raise LookupError(expr)
+    return result.value
+
+
+def describe_member(obj, key):
+    """(type, display name) of attribute key of obj or None if it can't be read"""
+    try:
+        val = getattr(obj, key)
+    except Exception:
+        return None
+    if inspect.ismethod(val):
         try:
-            val = getattr(result.value, key)
-        except Exception:
-            continue
-        name = key
-        if (inspect.ismethod(val)):
-            type = "function"
-            name += str(inspect.signature(val))
-        else:
-            type = "instance"
-        compl_data.append({
-            "name": name, "type": type,
-            "module_name": expr, "prefix": prefix,
-            "priority": 1000
-        })
-    return compl_data
+            return ("function", key + str(inspect.signature(val)))
+        except (TypeError, ValueError):
+            return ("function", key + "()")
+    return ("instance", key)
+
+
+class MemberCache(object):
+    """Caches what describe_member reports for the attributes of objects. Modules
+    and classes are cached by identity, other objects by their type, in which
+    case only attributes defined by the type are cached and instance attributes
+    are looked at every time. Everything is dropped when an eval may have
+    changed a module namespace (see lively.eval.namespace_versions)."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.version = None
+
+    def entry_for(self, obj):
+        version = sum(namespace_versions.values())
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+        by_identity = inspect.ismodule(obj) or inspect.isclass(obj)
+        key = id(obj) if by_identity else type(obj)
+        entry = self.entries.get(key)
+        if entry is None or (by_identity and entry["obj"] is not obj):
+            entry = self.entries[key] = {
+                "obj": obj if by_identity else None,
+                "cacheable": None if by_identity else set(dir(type(obj))),
+                "members": {}
+            }
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        self.entries.move_to_end(key)
+        return entry
+
+    def members(self, obj):
+        """returns a list of (attribute name, type, display name)"""
+        entry = self.entry_for(obj)
+        cacheable, members = entry["cacheable"], entry["members"]
+        result = []
+        for key in dir(obj):
+            description = members.get(key)
+            if description is None:
+                description = describe_member(obj, key)
+                if description is None:
+                    continue
+                if cacheable is None or key in cacheable:
+                    members[key] = description
+            result.append((key,) + description)
+        return result
+
+
+member_cache = MemberCache()
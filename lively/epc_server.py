@@ -30,6 +30,13 @@ Client code:
     (lambda (x) (message "Return : %S" x))))
 
 
+(deferred:$
+  (epc:call-deferred my-epc 'code_format_batch
+                     '((("a.py" "foo(3,4)") ("b.py" "bar( 1 )"))))
+  (deferred:nextc it
+    (lambda (x) (message "Return : %S" x))))
+
+
 (deferred:$
   (epc:call-deferred my-epc 'get_completions '("import os\nos.p" 2 4))
   (deferred:nextc it
@@ -43,29 +50,46 @@ Client code:
 
 from epc.server import EPCServer
 from lively.eval import run_eval
-from lively.code_formatting import code_format
+from lively.code_formatting import code_format, code_format_batch
 from lively.completions import get_completions
+from lively import metrics
 import asyncio
 
 
 def asyncio_wait(f):
     def wrapper(*args, **kwargs):
-        coro = asyncio.coroutine(f)
-        future = coro(*args, **kwargs)
-        loop = asyncio.get_event_loop()
-        return loop.run_until_complete(future)
+        async def call():
+            return await f(*args, **kwargs)
+        return asyncio.run(call())
     wrapper.__name__ = f.__name__
     return wrapper
 
 
-def start_server(host='localhost', port=0):
+async def format_batch(entries):
+    """epc can't stream, answers with the results of all entries in order"""
+    results = [result async for result in code_format_batch(entries)]
+    return sorted(results, key=lambda result: result["index"])
+
+
+def start_server(host='localhost', port=0, metrics_port=None):
+    """metrics_port: serve the Prometheus text of lively.metrics on
+    http://127.0.0.1:metrics_port/metrics"""
+    if metrics_port:
+        metrics.serve_http("127.0.0.1", metrics_port)
     server = EPCServer((host, port))
-    server.register_function(asyncio_wait(run_eval))
-    server.register_function(code_format)
-    server.register_function(asyncio_wait(get_completions))
+    server.register_function(metrics.instrument(asyncio_wait(run_eval)))
+    server.register_function(metrics.instrument(code_format))
+    server.register_function(metrics.instrument(asyncio_wait(format_batch), "code_format_batch"),
+                             "code_format_batch")
+    server.register_function(metrics.instrument(asyncio_wait(get_completions)))
     server.print_port()
     server.serve_forever()
 
 
 if __name__ == '__main__':
-    start_server()
+    import argparse
+    parser = argparse.ArgumentParser(description='Starts an epc server for eval requests')
+    parser.add_argument('--port', dest="port", type=int, default=0, help='port, defaults to a free one that is printed on start')
+    parser.add_argument('--metrics-port', dest="metrics_port", type=int, default=None, help='serve Prometheus metrics on http://127.0.0.1:METRICS_PORT/metrics')
+    args = parser.parse_args()
+    start_server(port=args.port, metrics_port=args.metrics_port)
@@ -1,10 +1,23 @@
 import sys
-import io
 import asyncio
 import json
 import ast
+import pickle
+import itertools
+import threading
+import ctypes
+from collections import OrderedDict
 from sexpdata import SExpBase
 from logging import warning
+from lively.output_capture import EvalOutput, capture
+from lively.ast_helper import has_toplevel_await, bound_names
+from lively import executors
+from lively.inspect_helpers import bounded_repr, summarize
+from lively.handles import handles
+
+# default budget for the value repr of EvalResult.as_dict
+value_max_chars = 100000
+value_max_items = 1000
 
 
 class EvalResult(SExpBase):
@@ -18,14 +31,37 @@ class EvalResult(SExpBase):
         self.value = value
         self.is_error = is_error
 
-    def as_dict(self):
-        return {
+    def as_dict(self, value_mode="repr", max_chars=None, max_items=None, handle=False,
+                registry=None):
+        """value_mode "repr" serializes the value with a repr of at most max_chars
+        characters showing at most max_items container elements, "valueTruncated"
+        is added if it was cut. value_mode "summary" only sends the value's type,
+        length and a short repr. With handle the value is registered in
+        registry (a lively.handles.HandleRegistry, lively.handles.handles by
+        default) and "valueHandle" can be used to inspect it."""
+        result = {
             'isError': self.is_error,
             "isEvalResult": True,
-            "value": repr(self.value),
+            "value": None,
             "stdout": self.stdout,
             "stderr": self.stderr
         }
+        if value_mode == "summary":
+            summary = summarize(self.value)
+            result["value"] = summary["summary"]
+            result["valueType"] = summary["type"]
+            if "length" in summary:
+                result["valueLength"] = summary["length"]
+        else:
+            result["value"], truncated = bounded_repr(
+                self.value,
+                value_max_chars if max_chars is None else max_chars,
+                value_max_items if max_items is None else max_items)
+            if truncated:
+                result["valueTruncated"] = True
+        if handle and not self.is_error:
+            result["valueHandle"] = (registry or handles).register(self.value)
+        return result
 
     def json_stringify(self):
         return json.dumps(self.as_dict())
@@ -34,6 +70,74 @@ class EvalResult(SExpBase):
         return tosexp(self.as_dict())
 
 
+class EvalCancelled(Exception):
+    """value of the EvalResult of a cancelled or timed out evaluation"""
+
+
+class RemoteValue(object):
+    """Stands in for an eval result value that could not be pickled and sent
+    back from a worker process. Its repr is the repr of the original value."""
+
+    def __init__(self, value_repr):
+        self.value_repr = value_repr
+
+    def __repr__(self):
+        return self.value_repr
+
+
+class CodeCache(object):
+    """Bounded LRU cache of compiled eval code objects. Keys are (source,
+    template, filename) tuples, see Evaluation.compile_source."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        code = self._entries.get(key)
+        if code is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return code
+
+    def put(self, key, code):
+        self._entries[key] = code
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._entries), "maxsize": self.maxsize}
+
+
+code_cache = CodeCache()
+
+eval_ids = itertools.count(1)
+
+# eval id -> Evaluation, for evals started with Evaluation.start / run_eval
+running_evals = {}
+
+# guards Evaluation.thread_id, see Evaluation.sync_eval and cancel
+thread_lock = threading.Lock()
+
+# module name -> number of evals that ran in it, lets caches of module contents
+# notice that a namespace might have changed
+namespace_versions = {}
+
+
 class Evaluation(object):
 
     __validation_template__ = ("async def __eval_validation__():\n"
@@ -46,7 +150,7 @@ class Evaluation(object):
         "    import asyncio\n"
         "    loop = asyncio.get_event_loop()\n"
         "    future = asyncio.ensure_future(__eval__(), loop=loop)\n"
-        "    future.add_done_callback(lambda f: __eval_done__(f.exception() or f.result(), bool(f.exception())))\n"
+        "    __eval_started__(future)\n"
         "    if not loop.is_running():"
         "        loop.run_until_complete(future)\n"
         "except Exception as exc:\n"
@@ -61,15 +165,34 @@ class Evaluation(object):
     source: str = ""
     status: str = "not started"
     result: EvalResult = None
-
-    def __init__(self, source, module_name, connection):
+    executor = None
+    future = None
+    worker_future = None
+    thread_id = None
+    worker = None
+    cancel_error = None
+
+    def __init__(self, source, module_name=None, connection=None, output=None, eval_id=None,
+                 owner=None):
         self.source = source
         self.module_name = module_name
         self.connection = connection
-
-    def is_valid(self, source, allow_async=False, module=None):
-        source = self.__validation_template__.format("\n        ".join(source.splitlines()))
-        parsed = ast.parse(source, mode='exec')
+        self.output = output
+        self.id = eval_id if eval_id is not None else next(eval_ids)
+        self.owner = owner
+
+    @property
+    def key(self):
+        """key of the evaluation in running_evals"""
+        return (self.owner, self.id)
+
+    def unregister(self):
+        if running_evals.get(self.key) is self:
+            del running_evals[self.key]
+
+    def validate(self, parsed, allow_async=False):
+        """Checks the body of the wrapper function in parsed (a template parsed
+        with ast.parse) and returns a list of error messages."""
         errors = []
         for node in parsed.body[0].body:
             if not allow_async and isinstance(node, ast.Await):
@@ -82,36 +205,74 @@ class Evaluation(object):
                 if hasattr(node, "lineno"):
                     msg += " at line {}".format(node.lineno - 1)
                 errors.append(msg)
+        return errors
+
+    def is_valid(self, source, allow_async=False, module=None):
+        source = self.__validation_template__.format("\n        ".join(source.splitlines()))
+        errors = self.validate(ast.parse(source, mode='exec'), allow_async)
         return (len(errors) == 0, errors)
 
+    def rewrite(self, parsed):
+        """Makes the wrapper function in parsed return the value of the last
+        expression. Names bound at the top level of the evaluated source are
+        declared global so they are stored in the module directly."""
+        body = parsed.body[0].body
+        last_expr = body[-1]
+        if isinstance(last_expr, ast.Expr):
+            body[-1] = ast.copy_location(ast.Return(value=last_expr.value), last_expr)
+
+        # annotated names can't be declared global, keep only the assignment
+        body[:] = [PlainAssignments().visit(node) for node in body]
+
+        names = set()
+        for node in body:
+            names.update(bound_names(node))
+        if names:
+            body.insert(0, ast.copy_location(ast.Global(names=sorted(names)), body[0]))
+
+        return ast.fix_missing_locations(parsed)
+
     def prepare_source(self, source, template):
         callable_source = template.format(
             "\n        ".join(source.splitlines()))
-        parsed = ast.parse(callable_source, mode='exec')
+        return self.rewrite(ast.parse(callable_source, mode='exec'))
 
-        # return the last expression
-        last_expr = parsed.body[0].body[-1]
-        ret_val = last_expr.value if isinstance(
-            last_expr, ast.Expr) else ast.NameConstant(value=None)
-        ret_assign = ast.Assign(
-            targets=[ast.Name(id='__eval_result__', ctx=ast.Store())],
-            value=ret_val)
-        if (isinstance(last_expr, ast.Expr)):
-            parsed.body[0].body[-1] = ret_assign
-        else:
-            parsed.body[0].body.append(ret_assign)
-        # copy locals into globals so we "record" them
-        parsed.body[0].body.extend(
-            ast.parse(("globals().update(locals())\n"
-                       "return __eval_result__")).body)
+    def compile_source(self, source, template, filename):
+        """Validates, rewrites and compiles source wrapped in template with a
+        single parse. Compiled code objects are cached in code_cache."""
+        key = (source, template, filename)
+        code = code_cache.get(key)
+        if code is not None:
+            return code
 
-        return ast.fix_missing_locations(parsed)
+        callable_source = template.format(
+            "\n        ".join(source.splitlines()))
+        parsed = ast.parse(callable_source, mode='exec')
+        errors = self.validate(parsed, True)
+        if errors:
+            raise Exception("pre-eval errors:\n{}".format("\n".join(errors)))
+
+        code = compile(self.rewrite(parsed), filename, 'exec')
+        code_cache.put(key, code)
+        return code
 
     def sync_eval(self):
         """Evaluates self.source and returns EvalResult object synchronously. Changes in
         the module __dict__ of self.module_name will persist, such as declared toplevel
         variables."""
-        self.__eval__(self.__sync_template__)
+        # thread_id is only set while the eval runs, cancel() checks it under
+        # thread_lock so that it never interrupts the next job of the thread
+        with thread_lock:
+            self.thread_id = threading.get_ident()
+        try:
+            self.__eval__(self.__sync_template__)
+        finally:
+            with thread_lock:
+                self.thread_id = None
+                if self.cancel_error:
+                    # drop an EvalCancelled that was set but not raised yet
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                        ctypes.c_ulong(threading.get_ident()), None)
         return self.result
 
     def run_eval(self, when_done):
@@ -120,9 +281,9 @@ class Evaluation(object):
         variables."""
         return self.__eval__(self.__async_template__, when_done)
 
-    def __eval__(self, code_template, when_done=None):
-        "internal, do not use"
-
+    def eval_module(self):
+        """the module named self.module_name, imported if needed, __main__ if it
+        can't be found"""
         # if module is specified, look it up. If not loaded, import it.
         eval_in_module = sys.modules.get(self.module_name or "__main__" or __name__)
         if not eval_in_module:
@@ -137,49 +298,177 @@ class Evaluation(object):
 
         if not eval_in_module:
             raise Exception("[lively eval] could not find module " + self.module_name)
+        return eval_in_module
+
+    def __eval__(self, code_template, when_done=None):
+        "internal, do not use"
+        eval_in_module = self.eval_module()
 
-        # globals, locals for eval
+        # globals for eval, the template code around the eval function gets its own
+        # locals so that concurrent evals in the same module don't see each other's
+        # __eval_done__ / __eval_started__
         _globals = eval_in_module.__dict__
-        _locals = eval_in_module.__dict__
 
-        valid, errors = self.is_valid(self.source, True)
-        if not valid:
-            raise Exception("pre-eval errors:\n{}".format("\n".join(errors)))
+        filename = getattr(eval_in_module, "__file__", None) or "<lively eval>"
+        code = self.compile_source(self.source, code_template, filename)
 
         self.status = "started"
 
-        parsed = self.prepare_source(self.source, code_template)
-
         def __eval_done__(value, is_error=False):
-            call_count = _globals.get("__eval_done_called__")
-            if (call_count > 0):
+            if self.status == "done":
                 warning("[lively eval] done callback was called multiple times, ignoring")
             else:
-                _globals.__setitem__("__eval_done_called__", call_count + 1)
-                sys.stdout, sys.stderr = oldout, olderr
-                stdout = eval_output[0].getvalue()
-                stderr = eval_output[1].getvalue()
+                stdout = eval_output.getvalue("stdout")
+                stderr = eval_output.getvalue("stderr")
 
                 self.result = EvalResult(value, stdout, stderr, is_error)
                 self.status = "done"
+                namespace_versions[eval_in_module.__name__] = (
+                    namespace_versions.get(eval_in_module.__name__, 0) + 1)
                 if when_done:
                     when_done(self.result)
 
-        _globals.__setitem__("__eval_done__", __eval_done__)
-        _globals.__setitem__("__eval_done_called__", 0)
+        def __eval_started__(future):
+            self.future = future
+            future.add_done_callback(__task_done__)
+
+        def __task_done__(future):
+            if future.cancelled():
+                __eval_done__(self.cancel_error or EvalCancelled("eval cancelled"), True)
+            else:
+                exc = future.exception()
+                __eval_done__(exc or future.result(), bool(exc))
+
+        _locals = {"__eval_done__": __eval_done__, "__eval_started__": __eval_started__}
 
         # provide optional connection to eval for meta requests
         _globals.__setitem__("__lively_connection__", self.connection)
 
-        # capture stdout + stderr
-        oldout, olderr = sys.stdout, sys.stderr
-        eval_output = [io.StringIO(), io.StringIO()]
-        sys.stdout, sys.stderr = eval_output
+        # capture stdout + stderr of this eval, including tasks it starts
+        eval_output = self.output = self.output or EvalOutput()
+        with capture(eval_output):
+            exec(code, _globals, _locals)
 
+        return self
 
-        exec(compile(parsed, eval_in_module.__file__, 'exec'), _globals, _locals)
+    def start(self, executor=None, timeout=None):
+        """Starts the evaluation on the event loop or, with executor "thread" or
+        "process", in a pool of lively.executors. Returns a future resolving to the
+        EvalResult. While running the evaluation is listed in running_evals under
+        (owner, id) and can be stopped with cancel(). After timeout seconds it is
+        cancelled."""
+        if executor not in (None, "thread", "process"):
+            raise ValueError("unknown executor {}".format(executor))
+
+        loop = asyncio.get_event_loop()
+        result_fut = loop.create_future()
+        timer = None
+
+        def finish(result, error=None):
+            self.unregister()
+            if timer:
+                timer.cancel()
+            if result_fut.done():
+                return
+            if error:
+                result_fut.set_exception(error)
+            else:
+                result_fut.set_result(result)
 
-        return self
+        running_evals[self.key] = self
+        try:
+            if executor and not uses_await(self.source):
+                self.submit(executor, loop, finish)
+            else:
+                self.run_eval(finish)
+        except Exception:
+            self.unregister()
+            raise
+
+        if timeout and not result_fut.done():
+            timer = loop.call_later(
+                timeout, self.cancel,
+                EvalCancelled("eval {} timed out after {}s".format(self.id, timeout)))
+        return result_fut
+
+    def submit(self, executor, loop, finish):
+        """Runs the eval in the thread pool or in a worker process of its own
+        (see executors.acquire_worker) and calls finish(result, error) when it
+        is done"""
+        self.executor = executor
+        if executor == "thread":
+            self.worker_future = executors.get_executor(executor).submit(self.sync_eval)
+        else:
+            self.worker = executors.acquire_worker(executor)
+            self.worker_future = self.worker.submit(
+                _eval_in_process, self.source, self.module_name,
+                self.output.max_size if self.output else None)
+        self.future = asyncio.wrap_future(self.worker_future, loop=loop)
+        self.future.add_done_callback(lambda future: self.executor_done(future, finish))
+
+    def executor_done(self, future, finish):
+        if self.worker:
+            # a cancelled eval's worker was killed, see cancel
+            if not self.cancel_error:
+                executors.release_worker(self.executor, self.worker)
+            self.worker = None
+        if self.cancel_error:
+            finish(EvalResult(self.cancel_error, self.__output__("stdout"),
+                              self.__output__("stderr"), True))
+        elif future.exception():
+            finish(None, future.exception())
+        else:
+            finish(future.result())
+
+    def __output__(self, stream_name):
+        return self.output.getvalue(stream_name) if self.output else ""
+
+    def cancel(self, error=None):
+        """Stops a running evaluation, its result will be an error EvalResult with
+        error (an EvalCancelled by default) as value. Async evals are cancelled like
+        any task. Thread evals get EvalCancelled raised inside the worker thread
+        (this cannot interrupt blocking calls into C code). Process evals run in a
+        worker process of their own which is killed. Returns False if there is
+        nothing to cancel."""
+        if self.status == "done" or not self.future or self.future.done():
+            return False
+        self.cancel_error = error or EvalCancelled("eval {} cancelled".format(self.id))
+        if self.worker_future and not self.worker_future.cancel():
+            # already running
+            if self.executor == "thread":
+                with thread_lock:
+                    if self.thread_id:
+                        ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                            ctypes.c_ulong(self.thread_id), ctypes.py_object(EvalCancelled))
+            elif self.worker:
+                executors.kill(self.worker)
+        self.future.cancel()
+        return True
+
+
+class PlainAssignments(ast.NodeTransformer):
+    """Replaces annotated assignments to names with plain ones (a pass if there
+    is no value), also inside if, for, with and try blocks. Nested functions,
+    lambdas and classes are left alone, their names aren't declared global."""
+
+    def visit_AnnAssign(self, node):
+        if not isinstance(node.target, ast.Name):
+            return node
+        if node.value is None:
+            return ast.copy_location(ast.Pass(), node)
+        return ast.copy_location(ast.Assign(targets=[node.target], value=node.value), node)
+
+    def visit_FunctionDef(self, node):
+        return node
+
+    visit_AsyncFunctionDef = visit_ClassDef = visit_Lambda = visit_FunctionDef
+
+
+def cancel_eval(eval_id, error=None, owner=None):
+    """Cancels the running evaluation with id eval_id that was started for owner,
+    see Evaluation.cancel"""
+    evaluation = running_evals.get((owner, eval_id))
+    return evaluation.cancel(error) if evaluation else False
 
 
 def sync_eval(source, module_name=None):
@@ -189,13 +478,45 @@ def sync_eval(source, module_name=None):
     return Evaluation(source, module_name).sync_eval()
 
 
-def run_eval(source, module_name=None, connection=None):
+def _eval_in_process(source, module_name, max_output_size=None):
+    output = EvalOutput(max_output_size)
+    result = Evaluation(source, module_name, output=output).sync_eval()
+    try:
+        pickle.dumps(result.value)
+    except Exception:
+        result = EvalResult(RemoteValue(bounded_repr(result.value, value_max_chars, value_max_items)[0]),
+                            result.stdout, result.stderr, result.is_error)
+    return result
+
+
+def uses_await(source):
+    try:
+        return has_toplevel_await(ast.parse(source))
+    except SyntaxError:
+        return False
+
+
+def run_eval(source, module_name=None, connection=None, executor=None, output=None,
+             eval_id=None, timeout=None, owner=None):
     """Evalualtes source in module specified by module_name and returns future. Note
-    that you can use top-level await statements inside source."""
-    result_fut = asyncio.Future()
-    Evaluation(source, module_name, connection).run_eval(
-        lambda result: result_fut.set_result(result))
-    return result_fut
+    that you can use top-level await statements inside source.
+
+    executor can be "thread" or "process" to run source in the pools of
+    lively.executors instead of on the event loop thread. In thread mode the module
+    namespace is shared as usual, in process mode source runs in a copy of it
+    inside the worker process and changes are not visible here. Source that uses
+    top-level await always runs on the event loop.
+
+    output is an optional lively.output_capture.EvalOutput receiving stdout and
+    stderr while source runs. Worker processes cannot write to it, their output
+    only arrives with the result.
+
+    The evaluation is registered in running_evals under (owner, eval_id), eval_id
+    is generated if not given. owner, e.g. the connection that asked for the eval,
+    has to be passed to cancel_eval to stop it. It is cancelled automatically after
+    timeout seconds."""
+    evaluation = Evaluation(source, module_name, connection, output, eval_id, owner)
+    return evaluation.start(executor, timeout)
 
 
 # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
@@ -0,0 +1,109 @@
+"""
+Named thread and process pools for work that should not block the event loop.
+
+Pools are created lazily on first use. Use configure() to change the number
+of workers of a pool before (or between) uses:
+
+    from lively import executors
+    executors.configure("process", max_workers=2)
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+executor_types = {
+    "thread": ThreadPoolExecutor,
+    "process": ProcessPoolExecutor
+}
+
+# pool name -> [executor type, max_workers]; max_workers None means the
+# concurrent.futures default
+pool_specs = {
+    "thread": ["thread", None],
+    "process": ["process", None],
+    # jedi and the completion caches are not thread-safe
+    "completion": ["thread", 1],
+    # yapf keeps its style in a global and is CPU bound
+    "format": ["process", None]
+}
+
+_executors = {}
+
+# pool name -> idle single process executors, see acquire_worker
+_idle_workers = {}
+_workers_lock = threading.Lock()
+
+
+def get_executor(name):
+    executor = _executors.get(name)
+    if executor:
+        return executor
+    if name not in pool_specs:
+        raise ValueError("unknown executor {}, expected one of {}".format(
+            name, ", ".join(sorted(pool_specs))))
+    kind, max_workers = pool_specs[name]
+    executor = _executors[name] = executor_types[kind](max_workers=max_workers)
+    return executor
+
+
+def configure(name, max_workers=None, kind=None):
+    """Sets the size (and optionally the type) of the pool name. A running pool
+    is shut down and recreated with the new settings on next use."""
+    spec = pool_specs.get(name) or [kind or "thread", None]
+    pool_specs[name] = [kind or spec[0], max_workers]
+    shutdown(name, wait=False)
+
+
+def shutdown(name=None, wait=True):
+    names = [name] if name else list(set(_executors) | set(_idle_workers))
+    for ea in names:
+        executor = _executors.pop(ea, None)
+        if executor:
+            executor.shutdown(wait=wait)
+        with _workers_lock:
+            idle = _idle_workers.pop(ea, [])
+        for worker in idle:
+            worker.shutdown(wait=wait)
+
+
+def kill(executor):
+    """Kills the worker processes of a process executor, tasks running in it fail"""
+    # concurrent.futures has no public API for this
+    for process in list((getattr(executor, "_processes", None) or {}).values()):
+        process.terminate()
+    executor.shutdown(wait=False)
+
+
+def terminate(name):
+    """Kills the worker processes of the process pool name, tasks running in it
+    fail. The pool is recreated on next use."""
+    executor = _executors.pop(name, None)
+    if executor:
+        kill(executor)
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+# workers of one task
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def acquire_worker(name="process"):
+    """A process executor with a single worker that runs only one task at a time,
+    so that the task can be stopped with kill without failing others.
+    Hand it back with release_worker when the task is done. Up to max_workers
+    of the pool name are kept idle for reuse."""
+    with _workers_lock:
+        idle = _idle_workers.get(name)
+        if idle:
+            return idle.pop()
+    return ProcessPoolExecutor(max_workers=1)
+
+
+def release_worker(name, worker):
+    max_idle = pool_specs.get(name, [None, None])[1] or os.cpu_count() or 1
+    with _workers_lock:
+        idle = _idle_workers.setdefault(name, [])
+        if len(idle) < max_idle:
+            idle.append(worker)
+            return
+    worker.shutdown(wait=False)
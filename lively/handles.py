@@ -0,0 +1,130 @@
+"""
+Opaque handles for eval results, so that clients can explore large objects
+one level at a time with "inspect" requests instead of receiving one big
+repr or re-evaluating expressions.
+
+The registry keeps the maxsize most recently used objects alive. Objects
+that support weak references stay reachable through their handle after
+being evicted for as long as something else keeps them alive.
+
+Handles are random tokens. The websocket server keeps a registry per
+connection (registry_for), so a client can only inspect the values of its
+own evals.
+
+    from lively.handles import handles
+    handle = handles.register(obj)
+    handles.inspect(handle, offset=0, limit=100)
+"""
+
+import secrets
+import weakref
+from collections import OrderedDict
+
+from lively.inspect_helpers import summarize, has_children, object_children
+
+
+class HandleRegistry(object):
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.recent = OrderedDict()  # handle -> obj, strong references
+        self.weak = weakref.WeakValueDictionary()  # handle -> obj
+        self.by_id = {}  # id(obj) -> handle, for the objects in recent
+
+    def register(self, obj):
+        """returns the handle of obj, the same handle for the same object"""
+        handle = self.by_id.get(id(obj))
+        if handle is not None:
+            try:
+                if self.get(handle) is obj:
+                    return handle
+            except KeyError:
+                pass
+        handle = "h" + secrets.token_urlsafe(12)
+        self.by_id[id(obj)] = handle
+        self.recent[handle] = obj
+        try:
+            self.weak[handle] = obj
+        except TypeError:
+            pass  # lists, dicts, ints, ... can't be weakly referenced
+        self.__evict__()
+        return handle
+
+    def get(self, handle):
+        """the object of handle, raises KeyError if it is gone"""
+        if handle in self.recent:
+            self.recent.move_to_end(handle)
+            return self.recent[handle]
+        obj = self.weak[handle]
+        self.recent[handle] = obj
+        self.__evict__()
+        return obj
+
+    def release(self, handle):
+        obj = self.recent.pop(handle, None)
+        self.weak.pop(handle, None)
+        if obj is not None and self.by_id.get(id(obj)) == handle:
+            del self.by_id[id(obj)]
+
+    def __evict__(self):
+        while len(self.recent) > self.maxsize:
+            handle, obj = self.recent.popitem(last=False)
+            if self.by_id.get(id(obj)) == handle:
+                del self.by_id[id(obj)]
+
+    def clear(self):
+        self.recent.clear()
+        self.weak.clear()
+        self.by_id.clear()
+
+    def describe(self, obj, name=None):
+        description = summarize(obj)
+        if name is not None:
+            description["name"] = name
+        if has_children(obj):
+            description["handle"] = self.register(obj)
+        return description
+
+    def inspect(self, handle, offset=0, limit=100):
+        """summary of the object of handle and of up to limit of its children,
+        children that have children themselves get a handle"""
+        obj = self.get(handle)
+        total, children = object_children(obj, offset, limit)
+        return {
+            **self.describe(obj),
+            "handle": handle,
+            "offset": offset,
+            "total": total,
+            "children": [self.describe(child, name) for name, child in children]
+        }
+
+
+handles = HandleRegistry()
+
+# connection -> HandleRegistry of the values of its evals
+connection_handles = {}
+
+
+def registry_for(connection):
+    """the HandleRegistry of connection, handles if connection is None"""
+    if connection is None:
+        return handles
+    registry = connection_handles.get(connection)
+    if registry is None:
+        registry = connection_handles[connection] = HandleRegistry(handles.maxsize)
+    return registry
+
+
+def release_registry(connection):
+    connection_handles.pop(connection, None)
+
+
+def inspect_handle(data, registry=handles):
+    """answer to an inspect request {handle, offset, limit}"""
+    if "handle" not in data:
+        return {"error": "needs handle"}
+    try:
+        return registry.inspect(data["handle"], data.get("offset") or 0,
+                                data.get("limit") or 100)
+    except KeyError:
+        return {"error": "unknown handle {}, the object is gone".format(data["handle"])}
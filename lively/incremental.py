@@ -0,0 +1,127 @@
+"""
+Incremental evaluation: re-run only the top-level statements of a buffer that
+changed since the last evaluation, plus the statements depending on them.
+
+For every module the statements of the last evaluated buffer are remembered.
+When a new version of the buffer is evaluated, statements are compared by
+their AST (so whitespace and comment edits don't count). A statement runs if
+
+- it is new or was edited,
+- it failed or did not run last time,
+- it reads a name bound by an earlier statement that runs, or
+- it contains a function, lambda or class whose body references a name bound
+  by any statement that runs (such bodies look up globals when they run,
+  possibly after later statements).
+
+The trailing expression of the buffer always runs so that its value can be
+returned. Statements are assumed to be repeatable: a skipped statement that
+mutated an object in place (list.append, x += 1) is not re-applied.
+"""
+
+import ast
+import asyncio
+from difflib import SequenceMatcher
+
+from lively.eval import run_eval, EvalResult
+from lively.output_capture import EvalOutput
+from lively.ast_helper import toplevel_statements, bound_names, referenced_names, \
+    late_bound_names
+
+# module name -> statements of the last evaluation, see Statement
+module_states = {}
+
+
+class Statement(object):
+
+    def __init__(self, node, source):
+        self.node = node
+        self.source = source
+        self.line = node.lineno
+        self.key = ast.dump(node)
+        self.defines = bound_names(node)
+        self.uses = referenced_names(node)
+        self.late_uses = late_bound_names(node)
+        self.done = False
+
+
+class IncrementalEvalResult(EvalResult):
+    """EvalResult that also reports the lines of the statements that ran and of
+    those that were skipped"""
+
+    def __init__(self, value, stdout="", stderr="", is_error=False, ran=(), skipped=()):
+        super().__init__(value, stdout, stderr, is_error)
+        self.ran = list(ran)
+        self.skipped = list(skipped)
+
+    def as_dict(self, *args, **kwargs):
+        return {**super().as_dict(*args, **kwargs), "ran": self.ran, "skipped": self.skipped}
+
+
+def statements_to_run(old, new):
+    """returns the set of indexes of the statements in new that need to run"""
+    old_keys = [ea.key if ea.done else None for ea in old]
+    matcher = SequenceMatcher(None, old_keys, [ea.key for ea in new], autojunk=False)
+    unchanged = set()
+    for a, b, size in matcher.get_matching_blocks():
+        unchanged.update(i for i in range(b, b + size) if old_keys[a + i - b] is not None)
+    dirty = set(range(len(new))) - unchanged
+    if new and isinstance(new[-1].node, ast.Expr):
+        dirty.add(len(new) - 1)
+
+    changed = True
+    while changed:
+        changed = False
+        for i, stmt in enumerate(new):
+            if i in dirty:
+                continue
+            if any(new[j].defines & (stmt.uses if j < i else stmt.late_uses)
+                   for j in dirty):
+                dirty.add(i)
+                changed = True
+    return dirty
+
+
+async def run_incremental_eval(source, module_name=None, connection=None, executor=None,
+                               output=None, eval_id=None, timeout=None, owner=None):
+    """Like lively.eval.run_eval but only runs the statements of source that
+    changed since the last incremental eval in module_name (or depend on a
+    changed one). Returns an IncrementalEvalResult. The statements run one after
+    another with eval_id, so cancel_eval(eval_id, owner=owner) stops the statement currently
+    running and skips the rest. timeout applies to all statements together.
+    executor "process" is not supported: the namespace of skipped statements
+    would have to live on in the worker process that happened to run them."""
+    if executor == "process":
+        raise ValueError("incremental evals can't use the process executor")
+    statements = [Statement(node, src) for node, src in toplevel_statements(source)]
+    state_key = module_name or "__main__"
+    to_run = statements_to_run(module_states.get(state_key, []), statements)
+    output = output or EvalOutput()
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout if timeout else None
+
+    value, is_error, ran, skipped = None, False, [], []
+    for i, stmt in enumerate(statements):
+        if i not in to_run:
+            stmt.done = True
+            skipped.append(stmt.line)
+            continue
+        if is_error:
+            continue
+        remaining = max(0.001, deadline - loop.time()) if deadline else None
+        result = await run_eval(stmt.source, module_name, connection, executor,
+                                output, eval_id, remaining, owner)
+        ran.append(stmt.line)
+        value, is_error = result.value, result.is_error
+        stmt.done = not is_error
+
+    if not is_error and statements and len(statements) - 1 not in to_run:
+        value = None
+    module_states[state_key] = statements
+    return IncrementalEvalResult(value, output.getvalue("stdout"), output.getvalue("stderr"),
+                                 is_error, ran, skipped)
+
+
+def reset(module_name=None):
+    """forgets the evaluated statements of module_name, the next incremental eval
+    runs everything"""
+    module_states.pop(module_name or "__main__", None)
@@ -1,27 +1,62 @@
+import sys
 import math
-from collections import Iterable
+from collections import deque, defaultdict
+from collections.abc import Iterable, Sequence, Sized, Set
+from itertools import islice
 import pprint
+import reprlib
 
 # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 # tree printing
 # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
-def print_tree(node, print_fn, child_fn, depth=0):
-    printed = print_fn(node)
-    children = child_fn(node)
-    if children and len(children) > 0:
-        child_lines = []
-        *first, last = children
-        for child in first:
-            printed_child = print_tree(child, print_fn, child_fn, depth + 1)
-            first_line, *rest_lines = printed_child.splitlines()
-            child_lines.append("|-" + first_line)
-            child_lines.extend(map(lambda line: "| " + line, rest_lines))
-        first_last, *rest_last = print_tree(last, print_fn, child_fn, depth + 1).splitlines()
-        child_lines.append("\-" + first_last)
-        child_lines.extend(map(lambda line: "  " + line, rest_last))
-        printed += "\n" + "\n".join(child_lines)
-    return printed
+def iter_tree(node, print_fn, child_fn, max_nodes=None, max_lines=None):
+    """Yields the lines of print_tree one by one. Nodes are visited depth first
+    with an explicit stack, each line is built once from the prefix passed
+    down from its parent. After max_nodes nodes or max_lines lines a final
+    "..." line is yielded instead of the rest."""
+    # entries: (node, prefix of first line, prefix of the other lines)
+    stack = [(node, None, "")]
+    nodes = lines = 0
+    while stack:
+        node, first_prefix, rest_prefix = stack.pop()
+        if max_nodes is not None and nodes >= max_nodes:
+            yield "..."
+            return
+        nodes += 1
+        printed = print_fn(node)
+        children = child_fn(node)
+        children = list(children) if children else []
+        if first_prefix is None:
+            # the root is printed as is
+            label_lines = [printed]
+            first_prefix = ""
+        else:
+            label_lines = (printed + "\n" if children else printed).splitlines() or [""]
+        for i, line in enumerate(label_lines):
+            if max_lines is not None and lines >= max_lines:
+                yield "..."
+                return
+            lines += 1
+            yield (rest_prefix if i else first_prefix) + line
+        for i in reversed(range(len(children))):
+            if i == len(children) - 1:
+                stack.append((children[i], rest_prefix + "\\-", rest_prefix + "  "))
+            else:
+                stack.append((children[i], rest_prefix + "|-", rest_prefix + "| "))
+
+
+def print_tree(node, print_fn, child_fn, depth=0, max_nodes=None, max_lines=None):
+    """Renders node and its descendants (child_fn(node) returns the children)
+    as an ascii tree of print_fn(node) labels, see example1"""
+    return "\n".join(iter_tree(node, print_fn, child_fn, max_nodes, max_lines))
+
+
+def write_tree(stream, node, print_fn, child_fn, max_nodes=None, max_lines=None):
+    """like print_tree but writes the lines to stream as they are produced"""
+    for line in iter_tree(node, print_fn, child_fn, max_nodes, max_lines):
+        stream.write(line)
+        stream.write("\n")
 
 
 def example1():
@@ -66,18 +101,66 @@ def example2():
 # pretty printing
 # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
 
+def is_array_like(obj):
+    """numpy style arrays and objects with the buffer protocol other than
+    bytes / bytearray"""
+    if hasattr(type(obj), "__array_interface__") or hasattr(type(obj), "__array_struct__"):
+        return True
+    if isinstance(obj, (bytes, bytearray, str)):
+        return False
+    try:
+        memoryview(obj).release()
+    except TypeError:
+        return False
+    return True
+
+
+def array_info(obj):
+    """(shape, dtype, size, item) of an array-like, item(i) returns the i-th
+    element of the flattened array without copying the array"""
+    if hasattr(obj, "shape") and hasattr(obj, "dtype") and hasattr(obj, "flat"):
+        # numpy and look-alikes
+        return tuple(obj.shape), obj.dtype, obj.size, lambda i: obj.flat[i]
+    view = memoryview(obj)
+    if view.ndim > 1:
+        flat = view.cast("B").cast(view.format)
+    else:
+        flat = view
+    return tuple(view.shape), view.format, len(flat), lambda i: flat[i]
+
+
 def print_obj(obj, max_depth=math.inf):
     return PPrinter().print(obj, max_depth)
 
 class PPrinter():
+    """Pretty prints objects, dicts and iterables. Output is produced as a stream
+    of chunks (see chunks()) that only looks ahead as far as needed to decide
+    the layout of a container (about max_line_length characters), so printing
+    large structures needs little memory. Objects contained in themselves print
+    as <cycle>. Output stops after max_chars characters / max_lines lines.
+    Containers with more than max_items elements show only the first and last
+    max_items / 2 followed by "... N more", array-likes (numpy arrays, array,
+    memoryview) their shape, type and array_edge_items values of each end."""
+
+    cycle_marker = "<cycle>"
+    truncation_marker = "..."
+    array_edge_items = 3
 
     def __init__(self,
                  ignore_internal_attrs=False,
                  max_line_length=50,
-                 indent="  "):
+                 indent="  ",
+                 max_chars=None,
+                 max_lines=None,
+                 max_items=1000):
         self.ignore_internal_attrs = ignore_internal_attrs
         self.max_line_length = max_line_length
         self.indent = indent
+        self.max_chars = max_chars
+        self.max_lines = max_lines
+        self.max_items = max_items
+        self.truncated = False
+        self.active = set()
 
     def __getattr__(self, name):
         if name.startswith("stringify_"):
@@ -91,77 +174,479 @@ class PPrinter():
         return pprint.saferepr(string)
 
     def stringify_generic(self, obj, max_depth, depth):
-        if depth == max_depth:
-            return str(obj)
-
-        return "{} {}".format(
-            obj,
-            self.__stringify_dict_items__(obj.__dict__, max_depth, depth, False))
+        return "".join(self.__generic_chunks__(obj, max_depth, depth))
 
     def __stringify_dict_items__(self, dict, max_depth, depth, real_dict=True):
+        return "".join(self.__dict_chunks__(dict, max_depth, depth, real_dict))
+
+    def stringify_iterable(self, iterable, max_depth, depth):
+        return "".join(self.__iterable_chunks__(iterable, max_depth, depth))
+
+    def stringify(self, obj, max_depth=math.inf, depth=1):
+        chunks = self.__chunks__(obj, max_depth, depth)
+        return "".join(self.__limit__(chunks) if depth == 1 else chunks)
+
+    def chunks(self, obj, max_depth=math.inf):
+        """generator of the printed obj in pieces, stops at the output budget"""
+        return self.__limit__(self.__chunks__(obj, max_depth, 1))
+
+    def print(self, obj, max_depth=math.inf, file=None):
+        file = file or sys.stdout
+        for chunk in self.chunks(obj, max_depth):
+            file.write(chunk)
+        file.write("\n")
+
+    # -=-=-=-
+    # chunks
+
+    def __chunks__(self, obj, max_depth, depth):
+        if depth > max_depth:
+            yield "..."
+            return
+        string = self.__plain_string__(obj, max_depth, depth)
+        if string is not None:
+            yield string
+            return
+        if id(obj) in self.active:
+            yield self.cycle_marker
+            return
+        self.active.add(id(obj))
+        try:
+            yield from self.__container_chunks__(obj, max_depth, depth)
+        finally:
+            self.active.discard(id(obj))
+
+    def __plain_string__(self, obj, max_depth, depth):
+        """the printed obj if it is neither a container nor an object with a
+        __dict__, else None"""
+        if hasattr(obj, "__dict__"):
+            return None
+        if isinstance(obj, str):
+            return self.stringify_str(obj, max_depth, depth)
+        if is_array_like(obj):
+            return self.stringify_array(obj, max_depth, depth)
+        if not isinstance(obj, (dict, Iterable)):
+            return self.stringify_primitive(obj, max_depth, depth)
+        return None
+
+    def __hook__(self, name):
+        """the method name of a subclass if it defines or overrides it"""
+        method = getattr(type(self), name, None)
+        if method is None or method is getattr(PPrinter, name, None):
+            return None
+        return method
+
+    def __container_chunks__(self, obj, max_depth, depth):
+        """Chunks of dicts, iterables and objects. stringify_<type name>,
+        stringify_generic, __stringify_dict_items__ and stringify_iterable
+        methods of subclasses customize printing, they return a string."""
+        if hasattr(obj, "__dict__"):
+            hook = self.__hook__("stringify_" + type(obj).__name__)
+            hook = hook or self.__hook__("stringify_generic")
+            default = self.__generic_chunks__
+        elif isinstance(obj, dict):
+            hook = self.__hook__("__stringify_dict_items__")
+            default = self.__dict_chunks__
+        else:
+            hook = self.__hook__("stringify_iterable")
+            default = self.__iterable_chunks__
+        if hook:
+            yield hook(self, obj, max_depth, depth)
+        else:
+            yield from default(obj, max_depth, depth)
+
+    def stringify_array(self, obj, max_depth, depth):
+        """array(shape=(1000, 3), dtype=float64, [0.5, 1.0, 1.5, ..., 2.0, 2.5, 3.0])"""
+        try:
+            shape, dtype, size, item = array_info(obj)
+        except Exception:
+            return self.stringify_primitive(obj, max_depth, depth)
+        edge = self.array_edge_items
+        if size > 2 * edge:
+            indexes = list(range(edge)) + [None] + list(range(size - edge, size))
+        else:
+            indexes = range(size)
+        values = ", ".join("..." if i is None else str(item(i)) for i in indexes)
+        return "{}(shape={}, dtype={}, [{}])".format(type(obj).__name__, shape, dtype, values)
+
+    def __summarized__(self, items, length=None, tail=None):
+        """Yields (item, None) for the elements of the iterator items to print and
+        (None, marker) in place of those left out. tail is a function returning
+        the last n elements, length the number of elements if known."""
+        if self.max_items is None or (length is not None and length <= self.max_items):
+            for item in items:
+                yield item, None
+            return
+        head_size = self.max_items - self.max_items // 2 if tail else self.max_items
+        tail_size = self.max_items // 2 if tail else 0
+        head = 0
+        for item in items:
+            if head == head_size:
+                break
+            head += 1
+            yield item, None
+        else:
+            return
+        if length is None:
+            yield None, "..."
+            return
+        yield None, "... {} more".format(length - head_size - tail_size)
+        for item in tail(tail_size) if tail_size else ():
+            yield item, None
+
+    def __summarized_items__(self, dict):
+        def tail(n):
+            keys = list(islice(reversed(dict), n))[::-1]
+            return [(k, dict[k]) for k in keys]
+        if self.max_items is None:
+            return self.__summarized__(iter(dict.items()))
+        return self.__summarized__(iter(list(islice(dict.items(), self.max_items + 1))),
+                                   len(dict), tail)
+
+    def __summarized_elements__(self, iterable):
+        length = len(iterable) if isinstance(iterable, Sized) else None
+        tail = None
+        if isinstance(iterable, (Sequence, deque)):
+            tail = self.__sequence_tail__(iterable, length)
+        return self.__summarized__(iter(iterable), length, tail)
+
+    def __sequence_tail__(self, sequence, length):
+        """function returning the last n elements of sequence"""
+
+        def tail(n):
+            return (sequence[i] for i in range(length - n, length))
+        return tail
+
+    def __peek__(self, chunks, limit):
+        """reads from the generator chunks until more than limit characters were
+        read or it is exhausted, returns (text read, exhausted)"""
+        read, size = [], 0
+        for chunk in chunks:
+            read.append(chunk)
+            size += len(chunk)
+            if size > limit:
+                return "".join(read), False
+        return "".join(read), True
+
+    def __limit__(self, chunks):
+        """passes on chunks until max_chars / max_lines are reached"""
+        self.truncated = False
+        chars, lines = 0, 1
+        for chunk in chunks:
+            cut = None
+            if self.max_chars is not None and chars + len(chunk) > self.max_chars:
+                cut = self.max_chars - chars
+            if self.max_lines is not None and lines + chunk.count("\n") > self.max_lines:
+                pos = -1
+                for _ in range(self.max_lines - lines + 1):
+                    pos = chunk.find("\n", pos + 1)
+                cut = pos if cut is None else min(cut, pos)
+            if cut is not None:
+                self.truncated = True
+                chunks.close()
+                yield chunk[:cut] + self.truncation_marker
+                return
+            chars += len(chunk)
+            lines += chunk.count("\n")
+            yield chunk
+
+    def __generic_chunks__(self, obj, max_depth, depth):
         if depth == max_depth:
-            return "{...}"
+            yield str(obj)
+            return
+        yield "{} ".format(obj)
+        hook = self.__hook__("__stringify_dict_items__")
+        if hook:
+            yield hook(self, obj.__dict__, max_depth, depth, False)
+        else:
+            yield from self.__dict_chunks__(obj.__dict__, max_depth, depth, False)
 
-        members = list(dict.items())
-        members_stringified = []
-        current_max_line_length = self.max_line_length if len(members) < 5 else 0
-        rows = [[]]
-        current_row = rows[0]
-        row_length = 0
+    def __dict_chunks__(self, dict, max_depth, depth, real_dict=True):
+        """Members go into rows of up to max_line_length characters (one per row
+        with five or more members), a member containing a line break starts a
+        new row. If there is more than one row or the row is too long, each row
+        goes on a line of its own."""
+        if depth == max_depth:
+            yield "{...}"
+            return
+
+        limit = self.max_line_length if len(dict) < 5 else 0
+        # while everything fits into the first row the layout is undecided and
+        # the members are kept in first_row
+        indented = False
+        first_row = []
+        row_empty = True
+        row_length = 0  # capped at limit + 1, more makes no difference
+        first = True
 
-        for k, v in members:
-            if (self.ignore_internal_attrs and k.startswith("__")):
+        for item, marker in self.__summarized_items__(dict):
+            member = self.__member__(item, marker, max_depth, depth, real_dict)
+            if member is None:
                 continue
-            val_string = self.stringify(v, max_depth, depth + 1)
-            key_string = "'{}'".format(k) if real_dict else k
-            string = "{}: {}".format(key_string, val_string)
-            if (len(current_row) > 0 and (row_length + len(string) > current_max_line_length or "\n" in string)):
-                current_row = []
-                row_length = 0
-                rows.append(current_row)
-            current_row.append(string)
-            row_length += len(string)
-
-        members_stringified = list(map(lambda row: ", ".join(row), rows))
-        before_indent = ""
-        after_indent = ""
-        if len(rows) > 1 or row_length > current_max_line_length:
-            members_stringified = map(lambda ea: self.indent * depth + ea, members_stringified)
-            before_indent = "\n"
-            after_indent = "\n" + self.indent * (depth - 1)
-
-        return "{{{}{}{}}}".format(
-            before_indent,
-            ",\n".join(members_stringified),
-            after_indent)
+            prefix, value_chunks = member
+            text, exhausted = self.__peek__(value_chunks, limit - len(prefix))
+            string = prefix + text
+            new_row, length = self.__row_break__(string, exhausted, row_empty, row_length, limit)
+            row_length = min(limit + 1, length if new_row else row_length + length)
+            row_empty = False
 
-    def stringify_iterable(self, iterable, max_depth, depth):
+            if not indented:
+                if not new_row and row_length <= limit:
+                    first_row.append(string)
+                    continue
+                indented = True
+                yield "{\n"
+                if first_row:
+                    yield self.indent * depth + ", ".join(first_row)
+                    first = False
+            if first:
+                yield self.indent * depth
+                first = False
+            elif new_row:
+                yield ",\n" + self.indent * depth
+            else:
+                yield ", "
+            yield string
+            yield from value_chunks
+
+        if indented:
+            yield "\n" + self.indent * (depth - 1) + "}"
+        else:
+            yield "{{{}}}".format(", ".join(first_row))
+
+    def __row_break__(self, string, exhausted, row_empty, row_length, limit):
+        """(whether the member string starts a new row, its length). Members
+        that were not read completely count as longer than a row."""
+        if not exhausted:
+            return not row_empty, limit + 1
+        new_row = not row_empty and (row_length + len(string) > limit or "\n" in string)
+        return new_row, len(string)
+
+    def __member__(self, item, marker, max_depth, depth, real_dict):
+        """(prefix, chunks of the value) of a dict member, None if it is left out"""
+        if marker:
+            return marker, iter(())
+        k, v = item
+        if self.ignore_internal_attrs and k.startswith("__"):
+            return None
+        key_string = "'{}'".format(k) if real_dict else k
+        return "{}: ".format(key_string), self.__chunks__(v, max_depth, depth + 1)
+
+    def __iterable_chunks__(self, iterable, max_depth, depth):
+        """Items go on one line, unless one of them contains a line break or all
+        of them are longer than max_line_length, then each item gets a line."""
+        sep = ",\n{}".format(self.indent * depth)
+        # items seen before the layout is decided
+        items = []
+        items_length = 0
         multi_line = False
-        items_stringified = []
-        stringified_len = 0
-        for ea in iterable:
-            stringified = self.stringify(ea, max_depth, depth + 1)
-            stringified_len += len(stringified)
-            if (not multi_line and ("\n" in stringified or stringified_len > self.max_line_length)):
-                multi_line = True
-            items_stringified.append(stringified)
-        sep = ",\n{}".format(self.indent * depth) if multi_line else ", "
-        before = "\n{}".format(self.indent * depth) if multi_line else ""
-        after = "\n{}".format(self.indent * (depth - 1)) if multi_line else ""
-        return "[{}{}{}]".format(before, sep.join(items_stringified), after)
 
-    def stringify(self, obj, max_depth=math.inf, depth=1):
-        if depth > max_depth:
+        for ea, marker in self.__summarized_elements__(iterable):
+            item_chunks = iter((marker,)) if marker else self.__chunks__(ea, max_depth, depth + 1)
+            if multi_line:
+                yield sep
+                yield from item_chunks
+                continue
+            text, exhausted = self.__peek__(item_chunks, self.max_line_length - items_length)
+            items_length += len(text)
+            if exhausted and "\n" not in text and items_length <= self.max_line_length:
+                items.append(text)
+                continue
+            multi_line = True
+            yield "[\n{}".format(self.indent * depth)
+            for item in items:
+                yield item
+                yield sep
+            yield text
+            yield from item_chunks
+
+        if multi_line:
+            yield "\n{}]".format(self.indent * (depth - 1))
+        else:
+            yield "[{}]".format(", ".join(items))
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+# bounded repr
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+class BoundedRepr(reprlib.Repr):
+    """reprlib.Repr that shows at most max_items elements of builtin containers
+    and at most max_chars characters overall, and records in self.truncated
+    whether anything was left out. Unlike reprlib, dicts keep their order and
+    subclasses of dict, list, tuple, set and frozenset that don't define a repr
+    of their own (and those of collections, like defaultdict or Counter) are
+    bounded, too. max_chars is a budget spent while the repr is built: once it
+    is used up the remaining elements are shown as "..." without being looked
+    at, so huge nested values don't cost more than a small one."""
+
+    container_limits = {
+        "tuple": "maxtuple", "list": "maxlist", "array": "maxarray",
+        "dict": "maxdict", "set": "maxset", "frozenset": "maxfrozenset",
+        "deque": "maxdeque"
+    }
+
+    container_bases = (dict, list, tuple, set, frozenset)
+
+    def __init__(self, max_chars=100000, max_items=1000, max_level=20):
+        super().__init__()
+        self.max_chars = max_chars
+        self.maxlevel = max_level
+        for attr in self.container_limits.values():
+            setattr(self, attr, max_items)
+        self.maxstring = self.maxlong = self.maxother = max_chars
+        self.truncated = False
+        self.budget = max_chars
+
+    def repr(self, x):
+        self.truncated = False
+        self.budget = self.max_chars
+        return self.__cut__(super().repr(x), self.max_chars)
+
+    def repr1(self, x, level):
+        if self.budget <= 0:
+            self.truncated = True
             return "..."
-        if not hasattr(obj, "__dict__"):
-            if isinstance(obj, str):
-                return self.stringify_str(obj, max_depth, depth)
-            if isinstance(obj, dict):
-                return self.__stringify_dict_items__(obj, max_depth, depth, True)
-            if isinstance(obj, Iterable):
-                return self.stringify_iterable(obj, max_depth, depth)
-            return self.stringify_primitive(obj, max_depth, depth)
-        return getattr(self, "stringify_" + type(obj).__name__)(obj, max_depth, depth)
+        base = self.container_base(x)
+        limit_attr = self.container_limits.get((base or type(x)).__name__)
+        if level <= 0:
+            self.truncated = True
+        elif limit_attr and len(x) > getattr(self, limit_attr):
+            self.truncated = True
+        if limit_attr:
+            # brackets now, the elements pay for themselves
+            self.budget -= 2
+            if base:
+                return self.repr_subclass(x, base, level)
+            return super().repr1(x, level)
+        string = super().repr1(x, level)
+        # + 2 for the separator
+        self.budget -= len(string) + 2
+        return string
+
+    def container_base(self, x):
+        """the builtin container type x is a subclass of if it is shown like one,
+        reprlib looks up handlers by the exact type name only"""
+        x_type = type(x)
+        if x_type in self.container_bases:
+            return None
+        for base in self.container_bases:
+            if isinstance(x, base):
+                if x_type.__repr__ is base.__repr__ or x_type.__module__ == "collections":
+                    return base
+                return None
+        return None
+
+    def repr_subclass(self, x, base, level):
+        """like base or, for the types of collections, Name(<repr like base>)"""
+        items = getattr(self, "repr_" + base.__name__)(x, level)
+        if type(x).__repr__ is base.__repr__:
+            return items
+        if isinstance(x, defaultdict):
+            return "{}({!r}, {})".format(type(x).__name__, x.default_factory, items)
+        return "{}({})".format(type(x).__name__, items)
+
+    def __cut__(self, string, limit):
+        if len(string) <= limit:
+            return string
+        self.truncated = True
+        return string[:max(0, limit - 3)] + "..."
+
+    def repr_dict(self, x, level):
+        if not x:
+            return "{}"
+        if level <= 0:
+            return "{...}"
+        pieces = ["{}: {}".format(self.repr1(k, level - 1), self.repr1(v, level - 1))
+                  for k, v in islice(x.items(), self.maxdict)]
+        if len(x) > self.maxdict:
+            pieces.append("...")
+        return "{{{}}}".format(", ".join(pieces))
+
+    def repr_str(self, x, level):
+        limit = max(1, min(self.maxstring, self.budget))
+        return self.__cut__(repr(x[:limit + 1]), limit)
+
+    def repr_bytes(self, x, level):
+        limit = max(1, min(self.maxstring, self.budget))
+        return self.__cut__(repr(x[:limit + 1]), limit)
+
+    def repr_int(self, x, level):
+        return self.__cut__(repr(x), self.maxlong)
+
+    def repr_instance(self, x, level):
+        try:
+            string = repr(x)
+        except Exception:
+            return "<{} instance at {:#x}>".format(type(x).__name__, id(x))
+        return self.__cut__(string, self.maxother)
+
+
+def bounded_repr(obj, max_chars=100000, max_items=1000):
+    """returns (repr string, truncated)"""
+    printer = BoundedRepr(max_chars, max_items)
+    string = printer.repr(obj)
+    return string, printer.truncated
+
+
+def summarize(obj, max_chars=80, max_items=5):
+    """short description of obj: its type, its length if it has one and a small
+    repr"""
+    obj_type = type(obj)
+    summary = {
+        "type": "{}.{}".format(obj_type.__module__, obj_type.__qualname__),
+        "summary": bounded_repr(obj, max_chars, max_items)[0]
+    }
+    if hasattr(obj_type, "__len__"):
+        try:
+            summary["length"] = len(obj)
+        except Exception:
+            pass
+    if is_array_like(obj):
+        try:
+            shape, dtype, _, _ = array_info(obj)
+            summary["shape"], summary["dtype"] = list(shape), str(dtype)
+        except Exception:
+            pass
+    return summary
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+# object children, one level at a time
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def has_children(obj):
+    """whether object_children(obj) lists anything, without computing it"""
+    if isinstance(obj, (str, bytes, bytearray)) or is_array_like(obj):
+        return False
+    # before __dict__, subclasses like Counter or class L(list) have one
+    if isinstance(obj, (dict, Sequence, deque, Set)):
+        return len(obj) > 0
+    if hasattr(obj, "__dict__"):
+        return bool(obj.__dict__)
+    if isinstance(obj, Sized) and isinstance(obj, Iterable):
+        return len(obj) > 0
+    return False
+
 
-    def print(self, obj, max_depth):
-        return print(self.stringify(obj, max_depth))
+def object_children(obj, offset=0, limit=None):
+    """The children PPrinter would print for obj: dict items, elements of sized
+    containers or else the attributes in __dict__. Returns (total number of
+    children, [(name, child)]) for the children from offset to offset + limit.
+    Strings, array-likes and iterators have no children (iterating would consume
+    them)."""
+    if not has_children(obj):
+        return 0, []
+    end = None if limit is None else offset + limit
+    if isinstance(obj, dict):
+        return len(obj), [(bounded_repr(k, 80, 5)[0], v)
+                          for k, v in islice(obj.items(), offset, end)]
+    if isinstance(obj, (Sequence, deque)):
+        indexes = range(len(obj))[offset:end]
+        return len(obj), [(str(i), obj[i]) for i in indexes]
+    if hasattr(obj, "__dict__") and not isinstance(obj, Set):
+        items = obj.__dict__.items()
+        return len(obj.__dict__), [(str(k), v) for k, v in islice(items, offset, end)]
+    # sets and other sized iterables
+    return len(obj), [(str(i), ea) for i, ea in
+                      zip(range(offset, len(obj)), islice(obj, offset, end))]
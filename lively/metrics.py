@@ -0,0 +1,282 @@
+"""
+Counters, gauges and histograms of what the servers are doing, readable as a
+dict (the "stats" websocket action) or in the Prometheus text format, which
+serve_http can serve on a local port:
+
+    from lively import metrics
+    metrics.requests.inc(action="eval", status="ok")
+    with metrics.track("eval"):
+        ...
+    print(metrics.registry.prometheus_text())
+
+Metrics are updated from the event loop and from executor / epc threads, every
+metric has a lock of its own.
+"""
+
+import sys
+import time
+import asyncio
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(
+        name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+
+    type = None
+
+    def __init__(self, name, help=""):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values = {}  # label key -> value
+
+    def snapshot(self):
+        with self.lock:
+            values = [{"labels": dict(key), "value": self.export(value)}
+                      for key, value in self.values.items()]
+        return {"type": self.type, "help": self.help, "values": values}
+
+    def export(self, value):
+        return value
+
+    def samples(self):
+        """(suffix, label key, extra labels, value) in exposition order"""
+        with self.lock:
+            return [("", key, (), value) for key, value in self.values.items()]
+
+    def prometheus_text(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} {}".format(self.name, self.type)]
+        for suffix, key, extra, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, format_labels(key, extra),
+                                            format_value(value)))
+        return "\n".join(lines)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(label_key(labels), 0)
+
+
+class Gauge(Counter):
+
+    type = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[label_key(labels)] = value
+
+
+class Histogram(Metric):
+    """observations counted into cumulative buckets of upper bounds"""
+
+    type = "histogram"
+
+    def __init__(self, name, help="", buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        super().__init__(name, help)
+        self.buckets = sorted(buckets) + [float("inf")]
+
+    def observe(self, value, **labels):
+        key = label_key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = {"counts": [0] * len(self.buckets), "sum": 0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry["counts"][i] += 1
+                    break
+            entry["sum"] += value
+            entry["count"] += 1
+
+    def get(self, **labels):
+        entry = self.values.get(label_key(labels))
+        return self.export(entry) if entry else None
+
+    def export(self, entry):
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.buckets, entry["counts"]):
+            cumulative += count
+            buckets[format_value(bound)] = cumulative
+        return {"count": entry["count"], "sum": entry["sum"], "buckets": buckets}
+
+    def samples(self):
+        with self.lock:
+            entries = [(key, self.export(entry)) for key, entry in self.values.items()]
+        samples = []
+        for key, entry in entries:
+            for bound, count in entry["buckets"].items():
+                samples.append(("_bucket", key, (("le", bound),), count))
+            samples.append(("_sum", key, (), entry["sum"]))
+            samples.append(("_count", key, (), entry["count"]))
+        return samples
+
+
+class Registry(object):
+
+    def __init__(self, prefix="lively_"):
+        self.prefix = prefix
+        self.metrics = {}
+        self.started = time.time()
+
+    def add(self, metric):
+        metric.name = self.prefix + metric.name
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help=""):
+        return self.add(Counter(name, help))
+
+    def gauge(self, name, help=""):
+        return self.add(Gauge(name, help))
+
+    def histogram(self, name, help="", **opts):
+        return self.add(Histogram(name, help, **opts))
+
+    def snapshot(self):
+        """{uptime, metrics: {name: {type, help, values: [{labels, value}]}}}"""
+        return {"uptime": time.time() - self.started,
+                "metrics": {name: metric.snapshot() for name, metric in self.metrics.items()}}
+
+    def prometheus_text(self):
+        return "\n".join(metric.prometheus_text() for metric in self.metrics.values()) + "\n"
+
+    def clear(self):
+        for metric in self.metrics.values():
+            metric.clear()
+
+
+registry = Registry()
+
+requests = registry.counter("requests_total", "Requests handled, by action and status")
+in_flight = registry.gauge("requests_in_flight", "Requests being handled, by action")
+latency = registry.histogram("request_duration_seconds", "Time to handle a request, by action")
+message_size = registry.histogram(
+    "message_size_bytes", "Size of encoded messages, by direction (in / out)",
+    buckets=(64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304))
+connections = registry.gauge("connections", "Open websocket connections")
+
+
+@contextmanager
+def track(action, server="ws"):
+    """counts a request and its time while the block runs. The status is "ok",
+    "cancelled" or "error" if the block raises. The block gets a dict and can
+    set its "status", e.g. to "error" for requests answered with an error."""
+    in_flight.inc(action=action, server=server)
+    start = time.perf_counter()
+    request = {"status": "ok"}
+    try:
+        yield request
+    except BaseException as err:
+        request["status"] = "cancelled" if isinstance(err, asyncio.CancelledError) else "error"
+        raise
+    finally:
+        in_flight.dec(action=action, server=server)
+        requests.inc(action=action, server=server, status=request["status"])
+        latency.observe(time.perf_counter() - start, action=action, server=server)
+
+
+def instrument(func, action=None, server="epc"):
+    """wraps func so that its calls are tracked as requests of action"""
+    action = action or func.__name__
+
+    def wrapper(*args, **kwargs):
+        with track(action, server):
+            return func(*args, **kwargs)
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+# structured logging
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+def log_event(logger, event, level=logging.DEBUG, **fields):
+    """logs "event key=value ...", fields are also set on the log record"""
+    if not logger.isEnabledFor(level):
+        return
+    text = " ".join([event] + ["{}={!r}".format(key, value) for key, value in fields.items()])
+    logger.log(level, text, extra={"event": event, "fields": fields})
+
+
+def setup_logging(logger, debug=False):
+    """Logs to the stderr the process started with. Evals replace sys.stdout and
+    sys.stderr to capture their output, log lines must not end up in there."""
+    if not any(getattr(ea, "lively_handler", False) for ea in logger.handlers):
+        handler = logging.StreamHandler(sys.__stderr__)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(levelname)s %(message)s"))
+        handler.lively_handler = True
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(logging.DEBUG if debug else logging.INFO)
+    return logger
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+# http endpoint
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    registry = registry
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.registry.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_http(host="127.0.0.1", port=9943):
+    """Serves the Prometheus text of registry on http://host:port/metrics from a
+    daemon thread. Returns the HTTPServer, shutdown() stops it. Keep host
+    local, there is no authentication."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,128 @@
+"""
+Sorted-array prefix indexes of the names that plain identifiers and import
+statements complete to: the globals of the eval module, builtins, keywords,
+identifiers of the edited buffer and the names of importable modules.
+
+Lookups bisect a list of lowercased names, so a completion is a couple of
+comparisons instead of a jedi inference. The index of an eval module is
+rebuilt when lively.eval.namespace_versions says an eval ran in it, the module
+index when sys.modules grew.
+
+    from lively.name_index import name_index
+    name_index.identifier_completions("pri", "__main__")
+"""
+
+import re
+import sys
+import inspect
+import keyword
+import pkgutil
+import builtins
+from bisect import bisect_left
+
+from lively.eval import namespace_versions
+
+identifier_re = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def name_type(value):
+    if inspect.ismodule(value):
+        return "module"
+    if inspect.isclass(value):
+        return "class"
+    if callable(value):
+        return "function"
+    return "instance"
+
+
+class PrefixIndex(object):
+    """names with a type, found by case-insensitive prefix"""
+
+    def __init__(self, names_and_types):
+        entries = sorted({(name.lower(), name, type) for name, type in names_and_types})
+        self.keys = [key for key, _, _ in entries]
+        self.entries = [(name, type) for _, name, type in entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def complete(self, prefix):
+        """(name, type) pairs of the names starting with prefix, ignoring case"""
+        prefix = prefix.lower()
+        start = bisect_left(self.keys, prefix)
+        end = start
+        while end < len(self.keys) and self.keys[end].startswith(prefix):
+            end += 1
+        return self.entries[start:end]
+
+
+class NameIndex(object):
+
+    def __init__(self):
+        self.module_indexes = {}
+        self.static_index = None
+        self.buffer_index = (None, None)
+        self.importable_names = None
+        self.modules_index = (None, None)
+
+    def namespace_index(self, module_name):
+        module_name = module_name or "__main__"
+        version = namespace_versions.get(module_name, 0)
+        cached = self.module_indexes.get(module_name)
+        if cached and cached[0] == version:
+            return cached[1]
+        module = sys.modules.get(module_name)
+        # copy() so that evals running in other threads can't change the dict
+        # while we iterate it
+        namespace = module.__dict__.copy() if module else {}
+        index = PrefixIndex((name, name_type(value)) for name, value in namespace.items())
+        self.module_indexes[module_name] = (version, index)
+        return index
+
+    def builtins_index(self):
+        if not self.static_index:
+            names = [(name, name_type(value)) for name, value in vars(builtins).items()]
+            names.extend((name, "keyword") for name in keyword.kwlist)
+            self.static_index = PrefixIndex(names)
+        return self.static_index
+
+    def source_index(self, source):
+        if self.buffer_index[0] != source:
+            names = set(identifier_re.findall(source))
+            self.buffer_index = (source, PrefixIndex((name, "statement") for name in names))
+        return self.buffer_index[1]
+
+    def module_index(self):
+        if self.importable_names is None:
+            self.importable_names = {ea.name for ea in pkgutil.iter_modules()}
+            self.importable_names.update(sys.builtin_module_names)
+        size = len(sys.modules)
+        if self.modules_index[0] != size:
+            names = self.importable_names.union(
+                name for name in list(sys.modules) if "." not in name)
+            self.modules_index = (size, PrefixIndex((name, "module") for name in names))
+        return self.modules_index[1]
+
+    def identifier_completions(self, prefix, module_name=None, source=None):
+        """(name, type) pairs for a bare identifier, names of the eval module first,
+        then names in source, then builtins and keywords"""
+        indexes = [self.namespace_index(module_name)]
+        if source:
+            indexes.append(self.source_index(source))
+        indexes.append(self.builtins_index())
+        seen, result = set(), []
+        for index in indexes:
+            for name, type in index.complete(prefix):
+                if name not in seen:
+                    seen.add(name)
+                    result.append((name, type))
+        return result
+
+    def module_completions(self, prefix):
+        return self.module_index().complete(prefix)
+
+    def clear(self):
+        self.__init__()
+
+
+name_index = NameIndex()
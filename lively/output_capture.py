@@ -0,0 +1,159 @@
+"""
+Per-evaluation capturing of sys.stdout / sys.stderr.
+
+install() replaces the process-wide streams once with OutputRouter objects.
+Each write is sent to the EvalOutput found in the current_output context
+variable. asyncio tasks copy the context they are created in and every thread
+has its own context, so concurrent evals each receive only their own output
+and writes made outside of an eval go to the original streams.
+"""
+
+import io
+import sys
+import asyncio
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+current_output = ContextVar("lively_eval_output", default=None)
+
+# default cap of characters captured per evaluation, None for no limit
+max_output_size = 10 * 1024 * 1024
+
+
+class EvalOutput(object):
+    """Collects stdout and stderr of one evaluation. At most max_size characters
+    are accepted, later writes are dropped. Writes are passed on to on_write(stream_name,
+    text) if given; with keep=False they are not stored here."""
+
+    def __init__(self, max_size=None, on_write=None, keep=True):
+        self.streams = {"stdout": io.StringIO(), "stderr": io.StringIO()}
+        self.max_size = max_output_size if max_size is None else max_size
+        self.on_write = on_write
+        self.keep = keep
+        self.size = 0
+        self.truncated = False
+
+    def write(self, stream_name, text):
+        if self.truncated:
+            return
+        if self.max_size is not None and self.size + len(text) > self.max_size:
+            text = text[:self.max_size - self.size] + (
+                "\n[output truncated after {} characters]\n".format(self.max_size))
+            self.truncated = True
+        self.size += len(text)
+        if self.keep:
+            self.streams[stream_name].write(text)
+        if self.on_write:
+            self.on_write(stream_name, text)
+
+    def getvalue(self, stream_name):
+        return self.streams[stream_name].getvalue()
+
+
+class OutputStreamer(object):
+    """Batches writes into chunks {"stdout": str, "stderr": str} that are passed to
+    the coroutine function send on the event loop, one at a time and in order. A
+    batch is flushed when it reaches flush_size characters or flush_interval
+    seconds after its first write. write can be called from any thread, create
+    the streamer on the loop thread and await close() when done."""
+
+    def __init__(self, send, flush_size=4096, flush_interval=0.1, loop=None):
+        self.send = send
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.loop = loop or asyncio.get_event_loop()
+        self.lock = threading.Lock()
+        self.pending = {"stdout": [], "stderr": []}
+        self.pending_size = 0
+        self.flush_scheduled = False
+        self.queue = asyncio.Queue()
+        self.sender = self.loop.create_task(self.__send_chunks__())
+
+    def write(self, stream_name, text):
+        with self.lock:
+            self.pending[stream_name].append(text)
+            self.pending_size += len(text)
+            if self.pending_size >= self.flush_size:
+                callback = self.flush
+            elif not self.flush_scheduled:
+                self.flush_scheduled = True
+                callback = self.__schedule_flush__
+            else:
+                return
+        self.loop.call_soon_threadsafe(callback)
+
+    def __schedule_flush__(self):
+        self.loop.call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        with self.lock:
+            if self.pending_size == 0:
+                self.flush_scheduled = False
+                return
+            chunk = {name: "".join(texts) for name, texts in self.pending.items()}
+            self.pending = {"stdout": [], "stderr": []}
+            self.pending_size = 0
+            self.flush_scheduled = False
+        self.queue.put_nowait(chunk)
+
+    async def __send_chunks__(self):
+        while True:
+            chunk = await self.queue.get()
+            if chunk is None:
+                break
+            await self.send(chunk)
+
+    async def close(self):
+        """sends what is still pending and waits until all chunks are sent"""
+        self.flush()
+        self.queue.put_nowait(None)
+        await self.sender
+
+
+class OutputRouter(object):
+    """file-like object that dispatches writes to the active EvalOutput and
+    falls back to the stream it replaced"""
+
+    def __init__(self, name, fallback):
+        self.name = name
+        self.fallback = fallback
+
+    def write(self, text):
+        output = current_output.get()
+        if output is None:
+            return self.fallback.write(text)
+        output.write(self.name, text)
+        return len(text)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if current_output.get() is None and self.fallback:
+            self.fallback.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.fallback, name)
+
+
+def install():
+    """Installs the routers as sys.stdout / sys.stderr. Does nothing if they
+    are already in place, so it is cheap to call before every eval."""
+    if not isinstance(sys.stdout, OutputRouter):
+        sys.stdout = OutputRouter("stdout", sys.stdout)
+    if not isinstance(sys.stderr, OutputRouter):
+        sys.stderr = OutputRouter("stderr", sys.stderr)
+
+
+@contextmanager
+def capture(output):
+    """Routes all output written in the current context to output. Tasks
+    created inside the with block keep writing to it after the block exits."""
+    install()
+    token = current_output.set(output)
+    try:
+        yield output
+    finally:
+        current_output.reset(token)
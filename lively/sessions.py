@@ -0,0 +1,229 @@
+"""
+Isolated eval sessions backed by a pool of pre-started worker interpreters.
+
+A SessionManager keeps pool_size idle worker processes around. Each worker
+imports the modules listed in preload right after it starts, so that import
+cost is paid before a user sends the first eval. acquire(session) hands a
+worker to a session (a websocket connection, for example) and release(session)
+recycles it: the worker is stopped and a fresh one takes its place in the pool.
+Workers are not daemonic so that evals in them can use the "process"
+executor, the manager stops them on release, on shutdown and at exit.
+
+Requests are sent to workers over a multiprocessing pipe as
+{id, action, data} dicts. Workers handle them concurrently with the handlers
+of lively.ws_server and answer with the JSON-compatible payloads that the
+websocket server would send for that action, as {id, reply} (several for
+streamed eval output), followed by {id, done: true}.
+
+    from lively.sessions import SessionManager
+    import lively.ws_server
+    manager = SessionManager(pool_size=2, preload=["numpy", "pandas"]).start()
+    lively.ws_server.start(sessions=manager)
+"""
+
+import atexit
+import asyncio
+import traceback
+import threading
+import itertools
+import multiprocessing
+from collections import deque
+
+from lively import ws_server
+from lively.ws_server import Responder, Collector
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+# worker side
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+class WorkerChannel(Collector):
+    """Stands in for the websocket in a worker, every reply of the request is
+    sent to the server right away as {id, reply}"""
+
+    def __init__(self, request_id, send_reply):
+        Responder.__init__(self, None)
+        self.request_id = request_id
+        self.send_reply = send_reply
+
+    def collect(self, payload):
+        self.send_reply({"id": self.request_id, "reply": payload})
+
+    async def send(self, data):
+        self.collect(data)
+
+
+async def handle_worker_request(request, send_reply):
+    """Runs the ws_server handler of the request, so that sessions support the
+    same options (stream, incremental, cancel, ...). The end of the request is
+    sent as {id, done: true}."""
+    channel = WorkerChannel(request.get("id"), send_reply)
+    try:
+        await ws_server.handle_message(
+            {"action": request.get("action"), "data": request.get("data") or {}}, channel, None)
+    except Exception:
+        channel.collect({"error": traceback.format_exc()})
+    send_reply({"id": request.get("id"), "done": True})
+
+
+def read_requests(conn, loop, start_request):
+    """passes the requests from conn to start_request on loop, None at the end"""
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError, KeyboardInterrupt):
+            request = None
+        loop.call_soon_threadsafe(start_request, request)
+        if request is None:
+            break
+
+
+def worker_main(conn, preload):
+    for module_name in preload:
+        try:
+            __import__(module_name)
+        except Exception:
+            traceback.print_exc()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    def start_request(request):
+        if request is None:
+            loop.stop()
+        else:
+            asyncio.ensure_future(handle_worker_request(request, conn.send))
+
+    # requests run concurrently as tasks on the loop, a thread reads the pipe
+    threading.Thread(target=read_requests, args=(conn, loop, start_request),
+                     daemon=True).start()
+    loop.run_forever()
+
+
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+# server side
+# -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
+
+class Worker(object):
+    """a worker process and the pipe to talk to it. Requests are tagged with an
+    id and run concurrently in the worker, a thread reads the replies and hands
+    them to the waiting requests."""
+
+    def __init__(self, preload=(), context=multiprocessing):
+        self.conn, child_conn = context.Pipe()
+        # not daemonic, daemonic processes can't start the process executor's workers
+        self.process = context.Process(target=worker_main, args=(child_conn, list(preload)))
+        self.process.start()
+        child_conn.close()
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.pending = {}  # request id -> (loop, queue of replies)
+        threading.Thread(target=self.read_replies, daemon=True).start()
+
+    def read_replies(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            entry = self.pending.get(message.get("id"))
+            if entry:
+                loop, queue = entry
+                loop.call_soon_threadsafe(queue.put_nowait, message)
+        # the worker is gone, don't let requests wait forever
+        for loop, queue in list(self.pending.values()):
+            loop.call_soon_threadsafe(queue.put_nowait, {"reply": {"error": "session worker stopped"}})
+            loop.call_soon_threadsafe(queue.put_nowait, {"done": True})
+
+    async def replies(self, action, data):
+        """sends {action, data} to the worker and yields its replies"""
+        request_id = next(self.ids)
+        queue = asyncio.Queue()
+        self.pending[request_id] = (asyncio.get_event_loop(), queue)
+        try:
+            with self.lock:
+                self.conn.send({"id": request_id, "action": action, "data": data})
+            while True:
+                message = await queue.get()
+                if message.get("done"):
+                    return
+                yield message["reply"]
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def send_request(self, action, data):
+        """the last reply of the worker to {action, data}"""
+        reply = None
+        async for reply in self.replies(action, data):
+            pass
+        return reply
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def stop(self, timeout=1):
+        try:
+            with self.lock:
+                self.conn.send(None)
+        except (OSError, EOFError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class SessionManager(object):
+
+    def __init__(self, pool_size=2, preload=(), start_method="spawn"):
+        self.pool_size = pool_size
+        self.preload = list(preload)
+        self.context = multiprocessing.get_context(start_method)
+        self.idle = deque()
+        self.sessions = {}
+        self.lock = threading.RLock()
+        # multiprocessing joins non-daemonic processes at exit, stop them first
+        atexit.register(self.shutdown)
+
+    def start(self):
+        """fills the pool of idle workers"""
+        with self.lock:
+            while len(self.idle) < self.pool_size:
+                self.idle.append(Worker(self.preload, self.context))
+        return self
+
+    def acquire(self, session):
+        """returns the worker of session, handing out an idle one for new sessions"""
+        with self.lock:
+            worker = self.sessions.get(session)
+            if worker and worker.is_alive():
+                return worker
+            while self.idle:
+                worker = self.idle.popleft()
+                if worker.is_alive():
+                    break
+            else:
+                worker = Worker(self.preload, self.context)
+            self.sessions[session] = worker
+            self.start()
+            return worker
+
+    def release(self, session):
+        """stops the worker of session and replaces it in the pool"""
+        with self.lock:
+            worker = self.sessions.pop(session, None)
+        if worker:
+            worker.stop()
+            self.start()
+
+    def shutdown(self):
+        with self.lock:
+            workers = list(self.sessions.values()) + list(self.idle)
+            self.sessions.clear()
+            self.idle.clear()
+        for worker in workers:
+            worker.stop()
@@ -1,9 +1,36 @@
 import asyncio
+import json
+from websockets.exceptions import ConnectionClosed
 
 def async_test(f):
     def wrapper(*args, **kwargs):
-        coro = asyncio.coroutine(f)
-        future = coro(*args, **kwargs)
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(future)
+        loop.run_until_complete(f(*args, **kwargs))
     return wrapper
+
+
+class FakeWebsocket(object):
+    """records what the ws_server handlers send, recv() returns the incoming
+    messages and then waits until close() is called"""
+
+    def __init__(self, incoming=()):
+        self.sent = []
+        self.incoming = list(incoming)
+        self.closed = None
+
+    async def send(self, data):
+        self.sent.append(data)
+
+    async def recv(self):
+        if not self.incoming:
+            self.closed = self.closed or asyncio.Event()
+            await self.closed.wait()
+            raise ConnectionClosed(None, None)
+        return self.incoming.pop(0)
+
+    def close(self):
+        self.closed = self.closed or asyncio.Event()
+        self.closed.set()
+
+    def messages(self):
+        return [json.loads(ea) for ea in self.sent]
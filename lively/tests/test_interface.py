@@ -1,14 +1,33 @@
 # nodemon -x  python -- -m unittest lively/tests/test_interface.py
 
+import os
+import ast
 import sys
-from unittest import TestCase
+import array
+import time
+import types
+import asyncio
+from unittest import TestCase, skipIf
 import json
+import websockets
 
-from lively.eval import sync_eval, run_eval
-from lively.completions import get_completions
-from lively.code_formatting import code_format
+from lively.eval import Evaluation, EvalResult, sync_eval, run_eval, cancel_eval, running_evals, code_cache
+from lively import completions
+from lively.completions import get_completions, JediCache, MemberCache, legacy_jedi, \
+    rank_completions, get_index_completions
+from lively import code_formatting
+from lively.code_formatting import code_format, style_for, format_cache
+from lively.output_capture import EvalOutput
+from lively.sessions import SessionManager
+from lively.incremental import run_incremental_eval
+from lively import incremental
+from lively import ws_server
+from lively import wire, metrics
+from lively.inspect_helpers import PPrinter, print_tree
+from lively.handles import HandleRegistry
+from lively.ast_helper import walk_ast, visit_ast, position_index, expression_at
 
-from lively.tests.helper import async_test
+from lively.tests.helper import async_test, FakeWebsocket
 
 # runner = unittest.TextTestRunner()
 # suite = unittest.TestSuite()
@@ -31,6 +50,16 @@ class EvalTestCase(TestCase):
         self.assertEqual(sys.modules.get(mod_name).__dict__.get("a"), 3,
                          "top-level variable not in module dict")
 
+    def test_eval_leaves_no_helpers_in_module(self):
+        mod_name = "lively.tests.some-test-module"
+        sync_eval("global_var = global_var + 1\nimport os.path as osp", mod_name)
+        module_dict = sys.modules.get(mod_name).__dict__
+        self.assertEqual(module_dict.get("global_var"), 24)
+        self.assertIn("osp", module_dict)
+        for name in ["__eval_result__", "__eval_done__", "__eval_done_called__",
+                     "__eval_started__", "__eval__", "future", "loop"]:
+            self.assertNotIn(name, module_dict)
+
     @async_test
     async def test_async_eval_simple(self):
         result = await run_eval("1 + 2")
@@ -54,6 +83,324 @@ class EvalTestCase(TestCase):
         result = await run_eval(async_code + "await async_counter(0.5)")
         self.assertEqual(result.value, 6)
 
+    @async_test
+    async def test_concurrent_evals_capture_their_own_output(self):
+        src = ("import asyncio\n"
+               "print('{0}1')\n"
+               "await asyncio.sleep({1})\n"
+               "print('{0}2')\n")
+        a, b = await asyncio.gather(run_eval(src.format("a", 0.05)),
+                                    run_eval(src.format("b", 0.01)))
+        self.assertEqual(a.stdout, "a1\na2\n")
+        self.assertEqual(b.stdout, "b1\nb2\n")
+        self.assertEqual(sync_eval("import sys; print('x', file=sys.stderr)").stderr, "x\n")
+
+
+class ExecutorEvalTest(TestCase):
+
+    @async_test
+    async def test_thread_eval_keeps_module_namespace(self):
+        mod_name = "lively.tests.some-test-module"
+        result = await run_eval("import threading\n"
+                                "thread_var = threading.current_thread().name\n"
+                                "thread_var", mod_name, executor="thread")
+        self.assertNotEqual(result.value, "MainThread")
+        self.assertEqual(sync_eval("thread_var", mod_name).value, result.value)
+
+    @async_test
+    async def test_process_eval(self):
+        result = await run_eval("import os\nprint('hi')\nos.getpid()", executor="process")
+        self.assertNotEqual(result.value, os.getpid())
+        self.assertEqual(result.stdout, "hi\n")
+        result = await run_eval("lambda: 23", executor="process")
+        self.assertTrue(repr(result.value).startswith("<function"))
+
+    @async_test
+    async def test_await_runs_on_loop(self):
+        result = await run_eval("import asyncio\nawait asyncio.sleep(0)\n23", executor="thread")
+        self.assertEqual(result.value, 23)
+
+
+class OutputStreamingTest(TestCase):
+
+    def test_output_is_capped(self):
+        output = EvalOutput(max_size=10)
+        result = Evaluation("for i in range(100): print(i)", output=output).sync_eval()
+        self.assertTrue(output.truncated)
+        self.assertTrue(result.stdout.startswith("0\n1\n2\n3\n4\n"))
+        self.assertIn("truncated", result.stdout)
+
+    @async_test
+    async def test_streamed_eval(self):
+        ws = FakeWebsocket()
+        source = ("import asyncio\n"
+                  "for i in range(3):\n"
+                  "    print(i)\n"
+                  "    await asyncio.sleep(0.05)\n"
+                  "'done'")
+        await ws_server.handle_eval({"source": source, "stream": True, "evalId": "e1"}, ws)
+        *chunks, result = ws.messages()
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual({c["evalId"] for c in chunks}, {"e1"})
+        self.assertEqual("".join(c["stdout"] for c in chunks), "0\n1\n2\n")
+        self.assertEqual(result["evalId"], "e1")
+        self.assertEqual(result["value"], "'done'")
+        self.assertEqual(result["stdout"], "")
+
+
+class CancelEvalTest(TestCase):
+
+    @async_test
+    async def test_timeout(self):
+        result = await run_eval("import asyncio\nprint('before')\nawait asyncio.sleep(10)",
+                                eval_id="sleeper", timeout=0.1)
+        self.assertTrue(result.is_error)
+        self.assertIn("timed out", str(result.value))
+        self.assertEqual(result.stdout, "before\n")
+        self.assertNotIn((None, "sleeper"), running_evals)
+
+    @async_test
+    async def test_cancel_thread_eval(self):
+        future = run_eval("while True: pass", executor="thread", eval_id="spinner")
+        await asyncio.sleep(0.1)
+        self.assertTrue(cancel_eval("spinner"))
+        result = await future
+        self.assertTrue(result.is_error)
+        self.assertFalse(cancel_eval("spinner"))
+
+    @async_test
+    async def test_cancel_process_eval_spares_other_evals(self):
+        other = run_eval("import time\ntime.sleep(0.5)\n23", executor="process")
+        future = run_eval("import time\ntime.sleep(10)", executor="process", eval_id="sleeper")
+        await asyncio.sleep(0.2)
+        self.assertTrue(cancel_eval("sleeper"))
+        self.assertTrue((await future).is_error)
+        self.assertEqual((await other).value, 23)
+
+    def test_finished_thread_eval_cannot_be_interrupted(self):
+        evaluation = Evaluation("1")
+        evaluation.sync_eval()
+        self.assertIsNone(evaluation.thread_id)
+
+    @async_test
+    async def test_cancel_action(self):
+        ws = FakeWebsocket()
+        source = "import asyncio\nawait asyncio.sleep(10)"
+        eval_task = asyncio.ensure_future(
+            ws_server.handle_eval({"source": source, "evalId": "ws-eval"}, ws))
+        await asyncio.sleep(0.05)
+        await ws_server.handle_message(
+            {"action": "cancel", "data": {"evalId": "ws-eval"}}, ws, None)
+        await eval_task
+        cancel_reply, result = ws.messages()
+        self.assertEqual(cancel_reply, {"evalId": "ws-eval", "cancelled": True})
+        self.assertEqual(result["evalId"], "ws-eval")
+        self.assertTrue(result["isError"])
+
+    @async_test
+    async def test_connections_only_cancel_their_own_evals(self):
+        owner, other = FakeWebsocket(), FakeWebsocket()
+        source = "import asyncio\nawait asyncio.sleep(0.2)\n'{}'"
+        evals = asyncio.gather(
+            ws_server.handle_eval({"source": source.format("owner"), "evalId": "e1"}, owner),
+            ws_server.handle_eval({"source": source.format("other"), "evalId": "e1"}, other))
+        await asyncio.sleep(0.05)
+        await ws_server.handle_cancel({"evalId": "e1"}, other)
+        await evals
+        self.assertEqual(owner.messages()[0]["value"], "'owner'")
+        cancelled, result = other.messages()
+        self.assertTrue(cancelled["cancelled"])
+        self.assertTrue(result["isError"])
+
+
+class EvalResultTest(TestCase):
+
+    def test_large_value_repr_is_bounded(self):
+        result = sync_eval("list(range(10 ** 6))")
+        as_dict = result.as_dict(max_items=3)
+        self.assertEqual(as_dict["value"], "[0, 1, 2, ...]")
+        self.assertTrue(as_dict["valueTruncated"])
+        self.assertEqual(len(result.as_dict(max_chars=20)["value"]), 20)
+        self.assertNotIn("valueTruncated", sync_eval("{'b': 1, 'a': 2}").as_dict())
+
+    def test_container_subclasses_are_bounded(self):
+        source = ("from collections import defaultdict, Counter, OrderedDict\n"
+                  "class L(list): pass\n"
+                  "n = 10 ** 6\n"
+                  "[defaultdict(int, dict.fromkeys(range(n), 0)), Counter(range(n)),\n"
+                  " OrderedDict.fromkeys(range(n)), L(range(n))]")
+        value = sync_eval(source).value
+        self.assertEqual([EvalResult(ea).as_dict(max_items=2)["value"] for ea in value],
+                         ["defaultdict(<class 'int'>, {0: 0, 1: 0, ...})",
+                          "Counter({0: 1, 1: 1, ...})",
+                          "OrderedDict({0: None, 1: None, ...})",
+                          "[0, 1, ...]"])
+
+    def test_huge_nested_values_are_bounded_while_printing(self):
+        start = time.time()
+        for value in ([[list(range(1000))] * 1000] * 50, ["x" * 100000] * 1000):
+            as_dict = EvalResult(value).as_dict(max_chars=1000)
+            self.assertEqual(len(as_dict["value"]), 1000)
+            self.assertTrue(as_dict["valueTruncated"])
+            self.assertLess(len(EvalResult(value).as_dict("summary")["value"]), 100)
+        self.assertLess(time.time() - start, 1)
+
+    def test_summary(self):
+        as_dict = sync_eval("list(range(10 ** 6))").as_dict("summary")
+        self.assertEqual(as_dict["valueType"], "builtins.list")
+        self.assertEqual(as_dict["valueLength"], 10 ** 6)
+        self.assertLess(len(as_dict["value"]), 100)
+
+
+class IncrementalEvalTest(TestCase):
+
+    @async_test
+    async def test_only_changed_statements_run(self):
+        mod_name = "lively.tests.some-test-module"
+        incremental.reset(mod_name)
+        source = ("loads = globals().get('loads', 0) + 1\n"
+                  "def scale(x):\n"
+                  "    return x * factor\n"
+                  "factor = {}\n"
+                  "other = 'unrelated'\n"
+                  "scale(loads)")
+        result = await run_incremental_eval(source.format(2), mod_name)
+        self.assertEqual(result.value, 2)
+        self.assertEqual(result.ran, [1, 2, 4, 5, 6])
+
+        result = await run_incremental_eval(source.format(3), mod_name)
+        self.assertEqual(result.value, 3)
+        self.assertEqual(result.skipped, [1, 5])
+        self.assertEqual(result.ran, [2, 4, 6])
+        self.assertEqual(result.as_dict()["skipped"], [1, 5])
+
+    @async_test
+    async def test_lambdas_and_classes_bind_late(self):
+        mod_name = "lively.tests.some-test-module"
+        incremental.reset(mod_name)
+        source = ("late_f = lambda: late_factor\n"
+                  "class LateK:\n"
+                  "    def get(self):\n"
+                  "        return late_factor\n"
+                  "late_factor = {}\n"
+                  "late_values = [late_f(), LateK().get()]\n"
+                  "late_values")
+        result = await run_incremental_eval(source.format(1), mod_name)
+        self.assertEqual(result.value, [1, 1])
+        result = await run_incremental_eval(source.format(2), mod_name)
+        self.assertEqual(result.value, [2, 2])
+        self.assertEqual(result.ran, [1, 2, 5, 6, 7])
+
+    @async_test
+    async def test_failed_statements_run_again(self):
+        incremental.reset()
+        result = await run_incremental_eval("inc_a = 1\ninc_b = inc_a / inc_zero\ninc_b")
+        self.assertTrue(result.is_error)
+        sync_eval("inc_zero = 1")
+        result = await run_incremental_eval("inc_a = 1\ninc_b = inc_a / inc_zero\ninc_b")
+        self.assertEqual(result.value, 1)
+        self.assertEqual(result.ran, [2, 3])
+
+    @async_test
+    async def test_annotated_assignments(self):
+        result = await run_incremental_eval("inc_ann: int = 5\ninc_bare: int\ninc_ann")
+        self.assertEqual(result.value, 5)
+        self.assertEqual(sync_eval("ann_x: int = 5\nann_x").value, 5)
+        self.assertFalse(sync_eval("ann_y: int").is_error)
+        self.assertEqual(sync_eval("if True:\n    ann_z: int = 2\nann_z").value, 2)
+        self.assertEqual(sync_eval("for i in range(2):\n    ann_i: int = i\nann_i").value, 1)
+        self.assertEqual(sync_eval("try:\n    ann_w: int\nexcept Exception:\n    pass\n3").value, 3)
+        self.assertEqual(sync_eval("def ann_f():\n    ann_v: int = 4\n    return ann_v\nann_f()").value, 4)
+
+    @async_test
+    async def test_process_executor_is_rejected(self):
+        with self.assertRaises(ValueError):
+            await run_incremental_eval("inc_p = 1", executor="process")
+
+
+class SessionTest(TestCase):
+
+    @async_test
+    async def test_sessions_are_isolated_and_recycled(self):
+        manager = SessionManager(pool_size=1, preload=["json"]).start()
+        try:
+            worker = manager.acquire("a")
+            reply = await worker.send_request("eval", {"source": "import os, sys\nsession_var = os.getpid()\n'json' in sys.modules"})
+            self.assertEqual(reply["value"], "True")
+            reply = await worker.send_request("eval", {"source": "session_var"})
+            self.assertNotEqual(reply["value"], str(os.getpid()))
+            self.assertIs(manager.acquire("a"), worker)
+            self.assertEqual(len(manager.idle), 1)
+
+            manager.release("a")
+            self.assertFalse(worker.is_alive())
+            reply = await manager.acquire("b").send_request("eval", {"source": "session_var"})
+            self.assertTrue(reply["isError"])
+        finally:
+            manager.shutdown()
+
+    @async_test
+    async def test_session_requests_run_concurrently(self):
+        manager = SessionManager(pool_size=1)
+        ws = FakeWebsocket()
+        ws_server.session_manager = manager
+        try:
+            source = "import time\nprint('started', flush=True)\ntime.sleep(10)"
+            eval_task = asyncio.ensure_future(ws_server.handle_message(
+                {"action": "eval", "data": {"source": source, "evalId": "s1", "stream": True,
+                                            "executor": "thread"}}, ws, None))
+            for _ in range(100):
+                if ws.sent:
+                    break
+                await asyncio.sleep(0.1)
+            await ws_server.handle_message(
+                {"action": "completion", "data": {"source": "imp", "row": 1, "column": 3}}, ws, None)
+            await ws_server.handle_message({"action": "cancel", "data": {"evalId": "s1"}}, ws, None)
+            await eval_task
+            output, completions, cancelled, result = ws.messages()
+            self.assertEqual(output["stdout"], "started\n")
+            self.assertIn("import", [ea["name"] for ea in completions])
+            self.assertEqual(cancelled, {"evalId": "s1", "cancelled": True})
+            self.assertTrue(result["isError"])
+        finally:
+            ws_server.session_manager = None
+            manager.shutdown()
+
+    @async_test
+    async def test_session_evals_can_use_process_executor(self):
+        manager = SessionManager(pool_size=0)
+        try:
+            worker = manager.acquire("a")
+            reply = await worker.send_request("eval", {"source": "import os\nos.getppid()",
+                                                       "executor": "process"})
+            self.assertFalse(reply["isError"], reply["value"])
+            self.assertEqual(reply["value"], str(worker.process.pid))
+            manager.release("a")
+            self.assertFalse(worker.is_alive())
+        finally:
+            manager.shutdown()
+
+
+class CodeCacheTest(TestCase):
+
+    def test_repeated_eval_uses_cache(self):
+        code_cache.clear()
+        self.assertEqual(sync_eval("x = 3\nx * 2").value, 6)
+        self.assertEqual(code_cache.stats()["misses"], 1)
+        self.assertEqual(sync_eval("x = 3\nx * 2").value, 6)
+        self.assertEqual(code_cache.stats()["hits"], 1)
+        self.assertEqual(len(code_cache), 1)
+
+    def test_cache_is_bounded(self):
+        code_cache.clear()
+        maxsize, code_cache.maxsize = code_cache.maxsize, 2
+        try:
+            for n in range(5):
+                sync_eval("{} + 1".format(n))
+            self.assertEqual(len(code_cache), 2)
+        finally:
+            code_cache.maxsize = maxsize
+
 
 class CompletionTest(TestCase):
 
@@ -67,6 +414,104 @@ class CompletionTest(TestCase):
                  'module_name': 'os',
                  'type': 'module'}.items()).issubset(set(path_compl.items())))
 
+    @async_test
+    async def test_newer_completion_request_supersedes_older(self):
+        ws = FakeWebsocket()
+        request = {"source": "import os\nos.p", "row": 2, "column": 4, "file": "f.py"}
+        first = asyncio.ensure_future(ws_server.handle_completion(request, ws))
+        await asyncio.sleep(0)
+        await ws_server.handle_completion({**request, "column": 3}, ws)
+        await first
+        older, newer = ws.messages()
+        self.assertIn("path", [c["name"] for c in newer])
+        self.assertTrue(older["superseded"])
+        self.assertEqual(ws_server.pending_completions, {})
+
+    @skipIf(legacy_jedi, "jedi < 0.16 has no reusable Script objects")
+    def test_jedi_state_is_reused_and_evicted(self):
+        cache = JediCache(max_files=2)
+        script = cache.script("import os\nos.", "a.py")
+        self.assertIs(cache.script("import os\nos.", "a.py"), script)
+        self.assertIsNot(cache.script("import os\nos.p", "a.py"), script)
+        cache.script("x", "b.py")
+        cache.script("y", "c.py")
+        self.assertEqual(list(cache.files), ["b.py", "c.py"])
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+
+    @async_test
+    async def test_runtime_completions_resolve_attributes_without_eval(self):
+        sys.modules["lively_completion_test"] = types.ModuleType("lively_completion_test")
+        sync_eval("class Runtime:\n  def greet(self, name): pass\nruntime_obj = Runtime()",
+                  "lively_completion_test")
+        calls = []
+        completions.run_eval = lambda *args: calls.append(args)
+        try:
+            result = await get_completions("runtime_obj.gr", 1, 14, None, "lively_completion_test")
+        finally:
+            completions.run_eval = run_eval
+        self.assertEqual(calls, [])
+        self.assertEqual([(c["name"], c["type"]) for c in result],
+                         [("greet(name)", "function")])
+
+    @async_test
+    async def test_ranked_and_limited_completions(self):
+        completions = await get_completions("import os\nos.pth", 2, 6, None,
+                                            ranked=True, limit=3, signatures=False)
+        self.assertEqual(len(completions), 3)
+        self.assertEqual(completions[0]["name"], "path")
+
+    def test_fuzzy_ranking(self):
+        names = ["_path", "PathLike", "fspath", "path", "pathsep", "other"]
+        self.assertEqual(rank_completions(names, "path"),
+                         ["path", "pathsep", "PathLike", "fspath", "_path"])
+        self.assertEqual(rank_completions(names, "pth", limit=2), ["path", "pathsep"])
+
+    @async_test
+    async def test_columns_payload_and_details(self):
+        ws = FakeWebsocket()
+        request = {"source": "import json\njson.dum", "row": 2, "column": 8,
+                   "limit": 10, "signatures": False, "format": "columns"}
+        await ws_server.handle_completion(request, ws)
+        await ws_server.handle_completion_details({**request, "name": "dumps"}, ws)
+        columns, details = ws.messages()
+        self.assertEqual(columns["name"][0], "dump")
+        self.assertEqual(len(columns["type"]), columns["rows"])
+        self.assertEqual(set(columns["module_path"]), {0})
+        self.assertIn("json", columns["modulePaths"][0])
+        self.assertIn("obj", details["signature"])
+        self.assertIn("JSON", details["doc"])
+
+    def test_name_index_follows_module_namespace(self):
+        sys.modules["lively_index_test"] = types.ModuleType("lively_index_test")
+        sync_eval("def indexed_fn(a, b): pass", "lively_index_test")
+        compls = get_index_completions("indexed", 1, 7, "lively_index_test")
+        self.assertEqual([(c["name"], c["type"]) for c in compls], [("indexed_fn(a,b)", "function")])
+        sync_eval("indexed_value = 3", "lively_index_test")
+        compls = get_index_completions("x = 1\nindexed", 2, 7, "lively_index_test")
+        self.assertEqual([c["full_name"] for c in compls], ["indexed_fn", "indexed_value"])
+        names = [c["full_name"] for c in get_index_completions("pri", 1, 3, "lively_index_test")]
+        self.assertIn("print", names)
+
+    def test_name_index_contexts(self):
+        compls = get_index_completions("import jso", 1, 10)
+        self.assertIn("json", [c["name"] for c in compls])
+        self.assertIsNone(get_index_completions("os.pa", 1, 5))
+        self.assertIsNone(get_index_completions("from os import pa", 1, 17))
+        self.assertIsNone(get_index_completions("x = 'pa", 1, 7))
+
+    def test_member_cache_is_per_type_and_invalidated_by_evals(self):
+        cache = MemberCache()
+        sys.modules["lively_member_cache_test"] = types.ModuleType("lively_member_cache_test")
+        sync_eval("class Cached:\n  def a(self): pass\nc1, c2 = Cached(), Cached()\nc1.x = 1",
+                  "lively_member_cache_test")
+        module = sys.modules["lively_member_cache_test"]
+        self.assertIn("x", [name for name, *_ in cache.members(module.c1)])
+        self.assertIs(cache.entry_for(module.c1), cache.entry_for(module.c2))
+        self.assertNotIn("x", [name for name, *_ in cache.members(module.c2)])
+        entry = cache.entry_for(module.c2)
+        sync_eval("c2.y = 2", "lively_member_cache_test")
+        self.assertIsNot(cache.entry_for(module.c2), entry)
+
 
 class CodeFormatTest(TestCase):
 
@@ -80,3 +525,439 @@ class CodeFormatTest(TestCase):
         src = "hello(1,\n2)\n\nfoo(\n1,\n2)"
         formatted = code_format(src, [(4, 6)], "<unknown>", None)
         self.assertEqual(formatted, "hello(1,\n2)\n\nfoo(1, 2)\n")
+
+    def test_styles_are_created_once(self):
+        config = {"based_on_style": "pep8", "indent_width": 2}
+        # nothing cached yet, as in a fresh process
+        code_formatting.styles.clear()
+        self.assertEqual(code_format("if x:\n    y()", None, "<unknown>", config), "if x:\n  y()\n")
+        self.assertIs(style_for(dict(config)), style_for(config))
+        self.assertEqual(code_format("if x:\n  y()", None, "<unknown>", None), "if x:\n    y()\n")
+
+    @async_test
+    async def test_format_results_are_cached(self):
+        ws = FakeWebsocket()
+        format_cache.clear()
+        request = {"source": "foo(\n1,\n2)", "lines": [[1, 3]], "metadata": True}
+        await ws_server.handle_code_format(request, ws)
+        await ws_server.handle_code_format(request, ws)
+        await ws_server.handle_code_format({"source": "foo(\n1,\n2)"}, ws)
+        first, second, plain = ws.messages()
+        self.assertEqual((first["formatted"], first["cached"]), ("foo(1, 2)\n", False))
+        self.assertEqual((second["formatted"], second["cached"]), ("foo(1, 2)\n", True))
+        self.assertEqual(plain, "foo(1, 2)\n")
+
+    @async_test
+    async def test_format_batch_streams_results_and_errors(self):
+        ws = FakeWebsocket()
+        entries = [{"file": "a.py", "source": "a(\n1)"}, ["b.py", "def ("], {"file": "c.py"}]
+        await ws_server.handle_code_format_batch({"entries": entries, "batchId": 7}, ws)
+        *results, done = ws.messages()
+        results = sorted(results, key=lambda r: r["index"])
+        self.assertEqual(results[0]["formatted"], "a(1)\n")
+        self.assertEqual(results[1]["file"], "b.py")
+        self.assertIn("error", results[1])
+        self.assertEqual(results[2]["error"], "needs source")
+        self.assertEqual(done, {"type": "codeFormatBatchDone", "batchId": 7,
+                                "count": 3, "errors": 2})
+
+
+class PPrinterTest(TestCase):
+
+    def test_unlimited_items(self):
+        self.assertEqual(PPrinter(max_items=None).stringify({"a": [1, 2]}), "{'a': [1, 2]}")
+
+    def test_subclass_hooks(self):
+        class Printer(PPrinter):
+            def stringify_iterable(self, iterable, max_depth, depth):
+                return "ITER"
+
+            def __stringify_dict_items__(self, dict, max_depth, depth, real_dict=True):
+                return "DICT"
+
+        self.assertEqual(Printer().stringify([1, [2]]), "ITER")
+        self.assertEqual(Printer().stringify({"a": 1}), "DICT")
+        self.assertEqual(Printer().stringify(types.SimpleNamespace(a=1)), "namespace(a=1) DICT")
+
+    def test_layout(self):
+        printer = PPrinter()
+        self.assertEqual(printer.stringify({"a": [1, 2], "b": "x"}), "{'a': [1, 2], 'b': 'x'}")
+        self.assertEqual(printer.stringify(list(range(40))),
+                         "[\n  " + ",\n  ".join(map(str, range(40))) + "\n]")
+
+    def test_cycles(self):
+        a = {"name": "a"}
+        a["self"] = a
+        b = [1, a]
+        self.assertEqual(PPrinter().stringify(b), "[1, {'name': 'a', 'self': <cycle>}]")
+        # shared but not cyclic
+        shared = [1]
+        self.assertEqual(PPrinter().stringify([shared, shared]), "[[1], [1]]")
+
+    def test_output_budget(self):
+        printer = PPrinter(max_chars=30)
+        printed = printer.stringify(range(10 ** 9))
+        self.assertEqual(len(printed), 33)
+        self.assertTrue(printer.truncated)
+        printer = PPrinter(max_lines=3)
+        self.assertEqual(printer.stringify(range(10 ** 9)), "[\n  0,\n  1,...")
+        self.assertEqual(list(PPrinter().chunks([1, 2]))[-1], "[1, 2]")
+
+    def test_large_containers_are_summarized(self):
+        printer = PPrinter(max_items=6)
+        self.assertEqual(printer.stringify(list(range(10 ** 6))),
+                         "[0, 1, 2, ... 999994 more, 999997, 999998, 999999]")
+        self.assertEqual(printer.stringify(x for x in range(10 ** 6)), "[0, 1, 2, 3, 4, 5, ...]")
+        printed = printer.stringify({str(i): i for i in range(100)})
+        self.assertIn("'2': 2,\n  ... 94 more,\n  '97': 97", printed)
+
+    def test_array_likes(self):
+        printed = PPrinter().stringify(array.array("d", range(10 ** 6)))
+        self.assertEqual(printed, "array(shape=(1000000,), dtype=d, "
+                                  "[0.0, 1.0, 2.0, ..., 999997.0, 999998.0, 999999.0])")
+        view = memoryview(bytes(range(4))).cast("B", (2, 2))
+        self.assertEqual(PPrinter().stringify(view), "memoryview(shape=(2, 2), dtype=B, [0, 1, 2, 3])")
+        self.assertEqual(PPrinter().stringify(b"ab"), "[97, 98]")
+
+
+class PrintTreeTest(TestCase):
+
+    tree = {"name": "foo", "children": [
+        {"name": "oi\nnk"},
+        {"name": "bark", "children": [{"name": "oooonka"}, {"name": "doooka"}]},
+        {"name": "zork"}]}
+
+    def print_tree(self, **limits):
+        return print_tree(self.tree, lambda node: node.get("name"),
+                          lambda node: node.get("children"), **limits)
+
+    def test_print_tree(self):
+        self.assertEqual(self.print_tree(), "\n".join([
+            "foo", "|-oi", "| nk", "|-bark", "| |-oooonka", "| \\-doooka", "\\-zork"]))
+
+    def test_limits(self):
+        self.assertEqual(self.print_tree(max_nodes=2), "foo\n|-oi\n| nk\n...")
+        self.assertEqual(self.print_tree(max_lines=2), "foo\n|-oi\n...")
+
+    def test_deep_tree(self):
+        root = node = {"name": "0"}
+        for i in range(1, 5000):
+            node["children"] = [{"name": str(i)}]
+            node = node["children"][0]
+        printed = print_tree(root, lambda node: node["name"], lambda node: node.get("children"))
+        self.assertEqual(printed.splitlines()[-1], " " * 2 * 4998 + "\\-4999")
+
+
+class InspectTest(TestCase):
+
+    def test_handles_are_reused_and_evicted(self):
+        registry = HandleRegistry(maxsize=2)
+        a, b, c = [1], [2], [3]
+        handle = registry.register(a)
+        self.assertEqual(registry.register(a), handle)
+        registry.register(b)
+        registry.register(c)
+        with self.assertRaises(KeyError):
+            registry.get(handle)
+
+    def test_weakly_referenced_objects_outlive_eviction(self):
+        registry = HandleRegistry(maxsize=1)
+        kept = EvalOutput()
+        handle = registry.register(kept)
+        registry.register(EvalOutput())
+        self.assertIs(registry.get(handle), kept)
+
+    @async_test
+    async def test_inspect_eval_result(self):
+        ws = FakeWebsocket()
+        await ws_server.handle_eval(
+            {"source": "{'xs': list(range(500)), 'n': 1}", "handle": True}, ws)
+        result, = ws.messages()
+        await ws_server.handle_inspect({"handle": result["valueHandle"]}, ws)
+        _, inspected = ws.messages()
+        self.assertEqual(inspected["total"], 2)
+        xs, n = inspected["children"]
+        self.assertEqual((n["name"], n["summary"]), ("'n'", "1"))
+        self.assertNotIn("handle", n)
+        await ws_server.handle_inspect({"handle": xs["handle"], "offset": 490, "limit": 20}, ws)
+        *_, items = ws.messages()
+        self.assertEqual((items["total"], items["length"]), (500, 500))
+        self.assertEqual([ea["name"] for ea in items["children"]], [str(i) for i in range(490, 500)])
+        await ws_server.handle_inspect({"handle": "nope"}, ws)
+        self.assertIn("error", ws.messages()[-1])
+
+    @async_test
+    async def test_handles_belong_to_their_connection(self):
+        owner, other = FakeWebsocket(), FakeWebsocket()
+        await ws_server.handle_eval({"source": "[1, 2]", "handle": True}, owner)
+        handle = owner.messages()[0]["valueHandle"]
+        await ws_server.handle_inspect({"handle": handle}, other)
+        self.assertIn("error", other.messages()[0])
+        await ws_server.handle_inspect({"handle": handle}, owner)
+        self.assertEqual(owner.messages()[1]["total"], 2)
+
+    @async_test
+    async def test_container_subclasses_have_children(self):
+        ws = FakeWebsocket()
+        source = ("from collections import Counter, OrderedDict\n"
+                  "class L(list): pass\n"
+                  "class S(set): pass\n"
+                  "[Counter('aab'), OrderedDict(x=1), L([1, 2, 3]), S([4])]")
+        await ws_server.handle_eval({"source": source, "handle": True}, ws)
+        result, = ws.messages()
+        await ws_server.handle_inspect({"handle": result["valueHandle"]}, ws)
+        counter, ordered, subclass, set_subclass = ws.messages()[1]["children"]
+        for child in (counter, ordered, subclass, set_subclass):
+            self.assertIn("handle", child)
+        await ws_server.handle_inspect({"handle": counter["handle"]}, ws)
+        inspected = ws.messages()[2]
+        self.assertEqual([(ea["name"], ea["summary"]) for ea in inspected["children"]],
+                         [("'a'", "2"), ("'b'", "1")])
+        await ws_server.handle_inspect({"handle": subclass["handle"]}, ws)
+        self.assertEqual(ws.messages()[3]["total"], 3)
+        await ws_server.handle_inspect({"handle": set_subclass["handle"]}, ws)
+        self.assertEqual(ws.messages()[4]["total"], 1)
+
+
+class AstHelperTest(TestCase):
+
+    def test_walk_deeply_nested_code(self):
+        source = "x = " + "(" * 90 + "1" + ")" * 90 + "\n" + "y = -" * 1 + "-" * 3000 + "1"
+        nodes = [type(node).__name__ for node, path in walk_ast(ast.parse(source))]
+        self.assertEqual(nodes.count("UnaryOp"), 3001)
+
+    def test_visit_ast_paths(self):
+        paths = [(type(node).__name__, path) for node, path in visit_ast(ast.parse("f(x)"))]
+        self.assertEqual(paths[3:6], [("Name", [["body", 0], ["value"], ["func"]]),
+                                      ("Load", [["body", 0], ["value"], ["func"], ["ctx"]]),
+                                      ("Name", [["body", 0], ["value"], ["args", 0]])])
+
+    def test_node_at_position(self):
+        source = "x = foo.bar(baz, 1 + 2)\n@deco(a)\ndef f(ü): return 'ö' + name\n"
+        self.assertEqual(expression_at(source, 1, 13), "baz")
+        self.assertEqual(expression_at(source, 1, 9), "foo.bar")
+        self.assertEqual(expression_at(source, 1, 19), "1 + 2")
+        self.assertEqual(expression_at(source, 2, 7), "a")
+        self.assertEqual(expression_at(source, 3, 26), "name")
+        self.assertIsInstance(position_index(source).node_at(3, 0), ast.FunctionDef)
+        self.assertIs(position_index(source), position_index(source))
+        self.assertIsNone(expression_at("x = (", 1, 3))
+
+
+class MessageHandlingTest(TestCase):
+
+    @async_test
+    async def test_replies_carry_request_ids(self):
+        ws = FakeWebsocket()
+        await ws_server.process_message(
+            json.dumps({"action": "eval", "id": "a1", "data": {"source": "1 + 2"}}), ws, None)
+        await ws_server.process_message(json.dumps({"action": "nope", "id": 7}), ws, None)
+        await ws_server.process_message(json.dumps({"action": "eval", "data": {"source": "3"}}), ws, None)
+        tagged, error, untagged = ws.messages()
+        self.assertEqual((tagged["id"], tagged["data"]["value"]), ("a1", "3"))
+        self.assertEqual(error["id"], 7)
+        self.assertIn("not understood", error["data"]["error"])
+        self.assertEqual(untagged["value"], "3")
+
+    @async_test
+    async def test_messages_do_not_wait_for_slow_evals(self):
+        slow = {"action": "eval", "id": 1, "data": {"source": "import asyncio\nawait asyncio.sleep(0.3)"}}
+        fast = {"action": "code_format", "id": 2, "data": {"source": "f( 1 )"}}
+        ws = FakeWebsocket([json.dumps(slow), json.dumps(fast)])
+        handler = asyncio.ensure_future(ws_server.handler(ws, None))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if ws.sent:
+                break
+        self.assertEqual(ws.messages(), [{"id": 2, "data": "f(1)\n"}])
+        ws.close()
+        await handler
+
+    @async_test
+    async def test_messages_without_id_are_answered_in_order(self):
+        slow = {"action": "eval", "data": {"source": "import asyncio\nawait asyncio.sleep(0.2)\n'slow'"}}
+        fast = {"action": "eval", "data": {"source": "'fast'"}}
+        ws = FakeWebsocket([json.dumps(slow), json.dumps(fast)])
+        handler = asyncio.ensure_future(ws_server.handler(ws, None))
+        for _ in range(100):
+            await asyncio.sleep(0.01)
+            if len(ws.sent) == 2:
+                break
+        self.assertEqual([ea["value"] for ea in ws.messages()], ["'slow'", "'fast'"])
+        ws.close()
+        await handler
+
+    @async_test
+    async def test_reading_stops_while_too_many_requests_are_pending(self):
+        slow = {"action": "eval", "id": 1, "data": {"source": "import asyncio\nawait asyncio.sleep(0.2)"}}
+        ws = FakeWebsocket([json.dumps(slow)] * 5)
+        original = ws_server.max_pending_requests
+        ws_server.max_pending_requests = 2
+        try:
+            handler = asyncio.ensure_future(ws_server.handler(ws, None))
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(ws.incoming), 3)
+            ws.close()
+            await handler
+        finally:
+            ws_server.max_pending_requests = original
+
+    @async_test
+    async def test_concurrency_limit(self):
+        running = []
+        limit = asyncio.Semaphore(2)
+        original = ws_server.process_message
+
+        async def process_message(message, websocket, path):
+            running.append(message)
+            await asyncio.sleep(0.05)
+        ws_server.process_message = process_message
+        try:
+            tasks = [asyncio.ensure_future(ws_server.process_message_limited(i, None, None, limit))
+                     for i in range(5)]
+            await asyncio.sleep(0.02)
+            self.assertEqual(running, [0, 1])
+            await asyncio.gather(*tasks)
+            self.assertEqual(running, [0, 1, 2, 3, 4])
+        finally:
+            ws_server.process_message = original
+
+
+class WireFormatTest(TestCase):
+
+    def test_json_envelope(self):
+        encoded = wire.json_codec.encode({"value": [1, 2], 3: "x"})
+        self.assertEqual(json.loads(wire.json_codec.envelope("a", encoded)),
+                         {"id": "a", "data": {"value": [1, 2], "3": "x"}})
+        self.assertEqual(json.loads(wire.json_codec.encode(2 ** 70)), 2 ** 70)
+
+    @skipIf(wire.msgpack is None, "msgpack is not installed")
+    def test_msgpack_envelope(self):
+        codec = wire.codecs["lively.msgpack"]
+        message = codec.envelope(5, codec.encode({"value": "1"}))
+        self.assertEqual(codec.decode(message), {"id": 5, "data": {"value": "1"}})
+
+    @async_test
+    async def test_negotiation(self):
+        server = await websockets.serve(ws_server.handler, "127.0.0.1", 0,
+                                        subprotocols=list(wire.codecs),
+                                        select_subprotocol=ws_server.select_subprotocol)
+        port = list(server.sockets)[0].getsockname()[1]
+        try:
+            for offered in ([], ["other", "lively.json"]):
+                async with websockets.connect("ws://127.0.0.1:{}".format(port),
+                                              subprotocols=offered or None) as ws:
+                    self.assertEqual(ws.subprotocol, "lively.json" if offered else None)
+                    await ws.send(json.dumps({"action": "eval", "id": 1, "data": {"source": "1"}}))
+                    self.assertEqual(json.loads(await ws.recv())["data"]["value"], "1")
+        finally:
+            server.close()
+            await server.wait_closed()
+
+
+class BatchTest(TestCase):
+
+    requests = [
+        {"action": "eval", "data": {"source": "batch_value = 41", "moduleName": "__main__"}},
+        {"action": "eval", "data": {"source": "print('hi'); batch_value + 1", "stream": True}},
+        {"action": "code_format", "data": {"source": "f( 1 )"}},
+        {"action": "completion", "data": {"source": "batch_val", "row": 1}},
+        {"action": "batch", "data": {}}]
+
+    @async_test
+    async def test_sequential_batch(self):
+        ws = FakeWebsocket()
+        await ws_server.handle_message(
+            {"action": "batch", "id": 3, "data": {"requests": self.requests}}, ws, None)
+        reply, = ws.messages()
+        self.assertEqual(reply["id"], 3)
+        results = reply["data"]["results"]
+        self.assertEqual(results[1]["result"]["value"], "42")
+        self.assertEqual(results[1]["messages"][0]["stdout"], "hi\n")
+        self.assertEqual(results[2]["result"], "f(1)\n")
+        self.assertEqual(results[3]["error"], "needs column")
+        self.assertIn("not allowed", results[4]["error"])
+        self.assertEqual(reply["data"]["errors"], 2)
+
+    @async_test
+    async def test_streamed_parallel_batch(self):
+        ws = FakeWebsocket()
+        requests = [{"action": "eval", "data": {"source": "import asyncio\nawait asyncio.sleep(0.1)\n1"}},
+                    {"action": "eval", "data": {"source": "2"}}]
+        await ws_server.handle_batch({"requests": requests, "parallel": True, "stream": True}, ws)
+        first, second, done = ws.messages()
+        self.assertEqual((first["index"], first["result"]["value"]), (1, "2"))
+        self.assertEqual((second["index"], second["result"]["value"]), (0, "1"))
+        self.assertEqual(done, {"type": "batchDone", "count": 2, "errors": 0})
+
+    @async_test
+    async def test_stop_on_error(self):
+        ws = FakeWebsocket()
+        requests = [{"action": "eval", "data": {"source": "1/0"}},
+                    {"action": "eval", "data": {"source": "batch_skipped = 2"}}]
+        await ws_server.handle_batch({"requests": requests, "stopOnError": True}, ws)
+        reply, = ws.messages()
+        self.assertTrue(reply["results"][0]["result"]["isError"])
+        self.assertIn("division by zero", reply["results"][0]["error"])
+        self.assertEqual(reply["results"][1], {"index": 1, "action": "eval", "skipped": True})
+        self.assertEqual(reply["errors"], 1)
+        self.assertFalse(hasattr(sys.modules["__main__"], "batch_skipped"))
+
+
+class MetricsTest(TestCase):
+
+    def test_prometheus_text(self):
+        registry = metrics.Registry("test_")
+        counter = registry.counter("things_total", "Things")
+        histogram = registry.histogram("size", "Sizes", buckets=(1, 10))
+        counter.inc(action="a")
+        counter.inc(2, action="a")
+        for value in (0.5, 5, 50):
+            histogram.observe(value)
+        text = registry.prometheus_text()
+        self.assertIn('# TYPE test_things_total counter\ntest_things_total{action="a"} 3\n', text)
+        self.assertIn('test_size_bucket{le="1"} 1\ntest_size_bucket{le="10"} 2\n'
+                      'test_size_bucket{le="+Inf"} 3\ntest_size_sum 55.5\ntest_size_count 3\n', text)
+
+    def test_track(self):
+        metrics.registry.clear()
+        with metrics.track("test"):
+            self.assertEqual(metrics.in_flight.get(action="test", server="ws"), 1)
+        with self.assertRaises(ValueError), metrics.track("test"):
+            raise ValueError()
+        self.assertEqual(metrics.in_flight.get(action="test", server="ws"), 0)
+        self.assertEqual(metrics.requests.get(action="test", server="ws", status="ok"), 1)
+        self.assertEqual(metrics.requests.get(action="test", server="ws", status="error"), 1)
+        self.assertEqual(metrics.latency.get(action="test", server="ws")["count"], 2)
+
+    @async_test
+    async def test_stats_action(self):
+        metrics.registry.clear()
+        ws = FakeWebsocket()
+        await ws_server.process_message('{"action": "code_format", "data": {"source": "f( 1 )"}}', ws, None)
+        await ws_server.process_message('{"action": "bogus"}', ws, None)
+        await ws_server.process_message('{"action": "eval", "data": {"source": "1 / 0"}}', ws, None)
+        await ws_server.process_message('{"action": "eval", "id": 1, "data": {}}', ws, None)
+        await ws_server.process_message('{"action": "stats"}', ws, None)
+        stats = ws.messages()[-1]["metrics"]
+        requests = {(ea["labels"]["action"], ea["labels"]["status"]): ea["value"]
+                    for ea in stats["lively_requests_total"]["values"]}
+        self.assertEqual(requests, {("code_format", "ok"): 1, ("other", "error"): 1,
+                                    ("eval", "error"): 2})
+        sizes, = stats["lively_message_size_bytes"]["values"]
+        self.assertEqual(sizes["labels"], {"direction": "out"})
+        self.assertEqual(sizes["value"]["count"], 4)
+
+    def test_message_sizes_are_bytes(self):
+        self.assertEqual(ws_server.encoded_size('"öö"'), 6)
+        self.assertEqual(ws_server.encoded_size(b"\x00\x01"), 2)
+
+    def test_http_endpoint(self):
+        from urllib.request import urlopen
+        server = metrics.serve_http("127.0.0.1", 0)
+        try:
+            with urlopen("http://127.0.0.1:{}/metrics".format(server.server_address[1])) as response:
+                self.assertIn("# TYPE lively_requests_total counter", response.read().decode())
+        finally:
+            server.shutdown()
+            server.server_close()
@@ -0,0 +1,80 @@
+"""
+Encodings of websocket messages.
+
+Clients pick one when connecting by asking for one of the websocket
+subprotocols in codecs ("lively.json", "lively.msgpack"). Clients that ask for
+none get JSON. JSON is encoded with orjson if it is installed, msgpack is only
+offered if the msgpack package is installed. Replies are sent as text frames
+for JSON and as binary frames for msgpack, incoming messages are decoded
+according to their frame type so JSON text frames are always understood.
+"""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec(object):
+
+    subprotocol = "lively.json"
+
+    def encode(self, payload):
+        if orjson:
+            try:
+                return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+            except (TypeError, orjson.JSONEncodeError):
+                pass  # e.g. ints beyond 64 bit, json can do those
+        return json.dumps(payload)
+
+    def decode(self, message):
+        if orjson:
+            return orjson.loads(message)
+        return json.loads(message)
+
+    def envelope(self, message_id, encoded):
+        """{id, data} with data already encoded"""
+        return '{{"id": {}, "data": {}}}'.format(self.encode(message_id), encoded)
+
+
+class MsgpackCodec(object):
+
+    subprotocol = "lively.msgpack"
+
+    def encode(self, payload):
+        return msgpack.packb(payload, use_bin_type=True)
+
+    def decode(self, message):
+        if isinstance(message, str):
+            return json.loads(message)
+        return msgpack.unpackb(message, raw=False, strict_map_key=False)
+
+    def envelope(self, message_id, encoded):
+        # a map of two entries, the value of "data" is spliced in as is
+        return b"\x82" + self.encode("id") + self.encode(message_id) + self.encode("data") + encoded
+
+
+json_codec = JsonCodec()
+
+# subprotocol -> codec, in order of preference
+codecs = {json_codec.subprotocol: json_codec}
+if msgpack:
+    codecs[MsgpackCodec.subprotocol] = MsgpackCodec()
+
+
+def codec_for(subprotocol):
+    return codecs.get(subprotocol) or json_codec
+
+
+def decode(message, codec=json_codec):
+    """text frames are JSON, binary ones use codec"""
+    if isinstance(message, str):
+        return json_codec.decode(message)
+    return codec.decode(message)
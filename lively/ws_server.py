@@ -1,120 +1,533 @@
 import asyncio
+import logging
 from multiprocessing import Process
-import json
 import traceback
 import websockets
-from lively.eval import run_eval
-from lively.completions import get_completions
-from lively.code_formatting import code_format
+from websockets.exceptions import ConnectionClosed
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+from lively.eval import run_eval, cancel_eval, eval_ids
+from lively.incremental import run_incremental_eval
+from lively.output_capture import EvalOutput, OutputStreamer
+from lively.completions import (get_completions, get_completion_details,
+                                prewarm_completions, completions_as_columns)
+from lively.code_formatting import run_code_format, code_format_batch
+from lively.handles import inspect_handle, registry_for, release_registry
+from lively import wire, metrics, executors
 
 def test():
     loop = asyncio.get_event_loop()
     start("0.0.0.0", 9942, loop)
 
 
+# log debug messages about requests, see start
 debug = True
+logger = logging.getLogger("lively.ws_server")
+
+# a lively.sessions.SessionManager, if set eval and completion requests of each
+# connection run in a worker process of their own
+session_manager = None
+
+# actions that run in the worker of the connection when sessions are used
+session_actions = ("eval", "cancel", "completion", "completion_details", "inspect")
+
+# flush policy for streamed eval output
+stream_flush_size = 4096
+stream_flush_interval = 0.1
+
+# requests of one connection that are handled at the same time, later ones wait
+max_concurrent_requests = 8
+
+# requests of one connection that may be waiting or running, no more messages
+# are read from the connection until one of them is done
+max_pending_requests = 64
+
+# permessage-deflate settings, None to turn compression off. Smaller windows
+# than zlib's default of 15 bits save memory per connection and still
+# compress repetitive payloads like completion lists and eval output well
+compression = {
+    "server_max_window_bits": 12,
+    "client_max_window_bits": 12,
+    "compress_settings": {"memLevel": 5}
+}
+
+
+def codec_of(websocket):
+    """the lively.wire codec the client of websocket asked for when connecting"""
+    return getattr(connection_of(websocket), "lively_codec", None) or wire.json_codec
+
+
+def select_subprotocol(*args):
+    """The first lively.wire codec the client offers, None (JSON) if it offers
+    none. Called with (client protocols, server protocols) by the legacy
+    websockets server and with (connection, client protocols) by the new one."""
+    offered = args[0] if isinstance(args[0], (list, tuple)) else args[1]
+    for protocol in offered:
+        if protocol in wire.codecs:
+            return protocol
+    return None
+
+
+def encoded_size(message):
+    """bytes of a websocket message, text messages are sent as UTF-8"""
+    return len(message.encode("utf-8")) if isinstance(message, str) else len(message)
+
+
+async def send(websocket, payload):
+    """encodes payload with the codec of the connection and sends it"""
+    if isinstance(websocket, Collector):
+        return websocket.collect(payload)
+    if isinstance(websocket, Responder) and reply_error(payload) is not None:
+        websocket.failed = True
+    encoded = codec_of(websocket).encode(payload)
+    metrics.message_size.observe(encoded_size(encoded), direction="out")
+    await websocket.send(encoded)
+
+
+class Responder(object):
+    """Stands in for the websocket while one message is handled. If the message
+    had an id the replies are sent as {id, data: reply} so that the client can
+    match them to its requests; replies to messages without id are sent as is.
+    failed records whether an error reply was sent. Everything else is
+    delegated to the websocket."""
+
+    def __init__(self, websocket, message_id=None):
+        self.websocket = websocket
+        self.message_id = message_id
+        self.failed = False
+
+    async def send(self, data):
+        if self.message_id is not None:
+            # data is already encoded, no need to decode it again
+            data = codec_of(self.websocket).envelope(self.message_id, data)
+        await self.websocket.send(data)
+
+    def __getattr__(self, name):
+        return getattr(self.websocket, name)
+
+
+class Collector(Responder):
+    """Responder for the sub-requests of a batch, keeps the replies instead of
+    sending them"""
+
+    def __init__(self, websocket):
+        super().__init__(connection_of(websocket))
+        self.replies = []
+
+    def collect(self, payload):
+        self.replies.append(payload)
+
+    async def send(self, data):
+        self.replies.append(data)
+
+
+def connection_of(websocket):
+    """the websocket connection behind a Responder"""
+    return websocket.websocket if isinstance(websocket, Responder) else websocket
 
 async def handle_eval(data, websocket):
+    """data: {source, moduleName, executor, stream, evalId, timeout, maxOutputSize,
+              valueMode, maxValueChars, maxValueItems, incremental, handle}
+    The result is sent with the evalId (generated if the client did not pass one)
+    that can be used in a cancel request. With stream: true output is sent while
+    the code runs as {type: "evalOutput", evalId, stdout, stderr} messages. With
+    handle: true the result has a valueHandle for inspect requests."""
     source = data.get("source")
     module_name = data.get("moduleName")
 
     if not source:
-        await websocket.send(json.dumps({"error": "needs source"}))
+        await send(websocket, {"error": "needs source"})
         return
 
-    if debug:
-        print("evaluating {}".format(
-            (source[:30] + "..." if len(source) > 30 else source).replace("\n", "")))
+    eval_id = data.get("evalId") or next(eval_ids)
+    metrics.log_event(logger, "eval", evalId=eval_id, module=module_name,
+                      source=(source[:30] + "..." if len(source) > 30 else source).replace("\n", ""))
+    streamer = None
+    if data.get("stream"):
+        async def send_output(chunk):
+            await send(websocket, {"type": "evalOutput", "evalId": eval_id, **chunk})
+        streamer = OutputStreamer(send_output, stream_flush_size, stream_flush_interval)
+        output = EvalOutput(data.get("maxOutputSize"), streamer.write, keep=False)
+    else:
+        output = EvalOutput(data.get("maxOutputSize"))
+
+    # incremental evals only run the statements changed since the last eval
+    evaluate = run_incremental_eval if data.get("incremental") else run_eval
+    try:
+        result = await evaluate(source, module_name, websocket, data.get("executor"),
+                                output, eval_id, data.get("timeout"), connection_of(websocket))
+    except asyncio.CancelledError:
+        cancel_eval(eval_id, owner=connection_of(websocket))
+        raise
+    finally:
+        if streamer:
+            await streamer.close()
 
-    result = await run_eval(source, module_name, websocket)
     # if debug: print("eval done", result, result.json_stringify())
-    await websocket.send(result.json_stringify())
+    if streamer and (result.stdout or result.stderr):
+        # output of worker processes arrives with the result
+        await send_output({"stdout": result.stdout, "stderr": result.stderr})
+        result.stdout = result.stderr = ""
+    value = result.as_dict(data.get("valueMode", "repr"),
+                           data.get("maxValueChars"), data.get("maxValueItems"),
+                           data.get("handle"), registry_for(connection_of(websocket)))
+    await send(websocket, {**value, "evalId": eval_id})
+
 
+async def handle_cancel(data, websocket):
+    if "evalId" not in data:
+        return await send(websocket, {"error": "needs evalId"})
+    eval_id = data.get("evalId")
+    cancelled = cancel_eval(eval_id, owner=connection_of(websocket))
+    await send(websocket, {"evalId": eval_id, "cancelled": cancelled})
+
+
+# (websocket, file) -> task computing completions
+pending_completions = {}
 
 async def handle_completion(data, websocket):
+    """data: {source, row, column, file, moduleName, ranked, limit, signatures, format}
+    With ranked (the default when a limit is given) completions are fuzzy
+    matched against the typed prefix and sorted best first, limit caps their
+    number. signatures: false leaves out function parameters, fetch them with
+    a completion_details request instead. format: "columns" sends the compact
+    form of lively.completions.completions_as_columns."""
     if "source" not in data:
-        return await websocket.send(json.dumps({"error": "needs source"}))
+        return await send(websocket, {"error": "needs source"})
     if "row" not in data:
-        return await websocket.send(json.dumps({"error": "needs row"}))
+        return await send(websocket, {"error": "needs row"})
     if "column" not in data:
-        return await websocket.send(json.dumps({"error": "needs column"}))
+        return await send(websocket, {"error": "needs column"})
 
-    completions = await get_completions(
+    # a newer request for the same file on this connection replaces a pending one
+    file = data.get("file") or "__workspace__.py"
+    key = (connection_of(websocket), file)
+    previous = pending_completions.get(key)
+    if previous:
+        previous.cancel()
+    task = pending_completions[key] = asyncio.ensure_future(get_completions(
         data.get("source"),
         data.get("row"),
         data.get("column"),
-        data.get("file") or "__workspace__.py")
-    if debug:
-        print("completions: {}".format(len(completions)))
-    await websocket.send(json.dumps(completions))
+        file,
+        data.get("moduleName"),
+        ranked=data.get("ranked", data.get("limit") is not None),
+        limit=data.get("limit"),
+        signatures=data.get("signatures", True)))
+    try:
+        completions = await task
+    except asyncio.CancelledError:
+        if pending_completions.get(key) is task:
+            raise
+        return await send(websocket, {"error": "completion request superseded by a newer one",
+                                      "superseded": True})
+    finally:
+        if pending_completions.get(key) is task:
+            del pending_completions[key]
+    metrics.log_event(logger, "completions", file=file, count=len(completions))
+    if data.get("format") == "columns":
+        completions = completions_as_columns(completions)
+    await send(websocket, completions)
+
+
+async def handle_inspect(data, websocket):
+    """data: {handle, offset, limit}, handle is the valueHandle of an eval
+    result (eval with handle: true) or the handle of a child listed by an
+    earlier inspect. Answers with the summary of the object and of up to limit
+    children starting at offset: {handle, type, summary, length, total, offset,
+    children: [{name, type, summary, length, handle}]}"""
+    await send(websocket, inspect_handle(data, registry_for(connection_of(websocket))))
+
+
+async def handle_completion_details(data, websocket):
+    """data: {source, row, column, name, file, moduleName}, answers with
+    {name, type, signature, doc} of the completion name"""
+    for key in ("source", "row", "column", "name"):
+        if key not in data:
+            return await send(websocket, {"error": "needs " + key})
+    details = await get_completion_details(
+        data.get("source"), data.get("row"), data.get("column"), data.get("name"),
+        data.get("file") or "__workspace__.py", data.get("moduleName"))
+    if details is None:
+        details = {"error": "no completion {}".format(data.get("name"))}
+    await send(websocket, details)
 
 async def handle_code_format(data, websocket):
+    """data: {source, lines, file, style, metadata}
+    Answers with the formatted source, or with metadata: true with
+    {formatted, cached, time}."""
     if "source" not in data:
-        return await websocket.send(json.dumps({"error": "needs source"}))
+        return await send(websocket, {"error": "needs source"})
 
     try:
-        formatted_code = code_format(
+        result = await run_code_format(
             data.get("source"),
             data.get("lines"),
             data.get("file") or "<unknown>",
             data.get("style"))
-        if debug:
-            print("code_format done")
-        answer = formatted_code
+        metrics.log_event(logger, "code_format", cached=result["cached"], time=result["time"])
+        answer = result if data.get("metadata") else result["formatted"]
     except Exception as err:
-        answer = json.dumps({'error': str(err)})
-    print(data.get("lines"))
-    await websocket.send(json.dumps(answer))
+        answer = {'error': str(err)}
+    await send(websocket, answer)
+
+
+async def handle_code_format_batch(data, websocket):
+    """data: {entries: [{file, source, lines, style}], batchId}
+    Each entry is answered as soon as it is formatted with
+    {type: "codeFormatResult", batchId, index, file, formatted, cached, time}
+    (or error instead of formatted), the end of the batch with
+    {type: "codeFormatBatchDone", batchId, count, errors}."""
+    entries = data.get("entries")
+    if not isinstance(entries, list):
+        return await send(websocket, {"error": "needs entries"})
+    batch_id = data.get("batchId")
+    errors = 0
+    async for result in code_format_batch(entries):
+        errors += "error" in result
+        await send(websocket, {"type": "codeFormatResult", "batchId": batch_id, **result})
+    await send(websocket, {"type": "codeFormatBatchDone", "batchId": batch_id,
+                           "count": len(entries), "errors": errors})
+
+
+async def handle_stats(data, websocket):
+    """answers with lively.metrics.registry.snapshot(): {uptime, metrics: {name:
+    {type, help, values: [{labels, value}]}}}, histogram values are {count,
+    sum, buckets: {upper bound: cumulative count}}"""
+    await send(websocket, metrics.registry.snapshot())
+
+
+def request_action(request):
+    return request.get("action") if isinstance(request, dict) else None
+
+
+def reply_error(reply):
+    """the error of a request from its reply, None if the request succeeded"""
+    if not isinstance(reply, dict):
+        return None
+    if "error" in reply:
+        return reply["error"]
+    if reply.get("isError"):
+        return reply.get("value") or "eval failed"
+    return None
+
+
+class Batch(object):
+    """the requests of a batch message and their results, see handle_batch"""
+
+    def __init__(self, requests, websocket, path=None, stream=False):
+        self.requests = requests
+        self.websocket = websocket
+        self.path = path
+        self.stream = stream
+        self.results = [None] * len(requests)
+
+    @property
+    def errors(self):
+        return sum(1 for ea in self.results if "error" in ea)
+
+    async def handle(self, request):
+        """{action, result, messages, error} of request"""
+        item = {"action": request_action(request)}
+        if item["action"] not in batch_actions:
+            item["error"] = "action {} not allowed in batches".format(item["action"])
+            return item
+        collector = Collector(self.websocket)
+        try:
+            await handle_message({"action": item["action"], "data": request.get("data") or {}},
+                                 collector, self.path)
+        except Exception:
+            item["error"] = traceback.format_exc()
+        if collector.replies:
+            *messages, item["result"] = collector.replies
+            if messages:
+                item["messages"] = messages
+            error = reply_error(item["result"])
+            if error is not None:
+                item.setdefault("error", error)
+        return item
+
+    async def finish(self, index, item):
+        item = self.results[index] = {"index": index, **item}
+        if self.stream:
+            await send(self.websocket, {"type": "batchItem", **item})
+        return item
+
+    async def run(self, index):
+        return await self.finish(index, await self.handle(self.requests[index]))
+
+    async def run_parallel(self):
+        await asyncio.gather(*[self.run(i) for i in range(len(self.requests))])
+
+    async def run_sequential(self, stop_on_error=False):
+        """with stop_on_error the requests after a failed one are skipped"""
+        for i in range(len(self.requests)):
+            item = await self.run(i)
+            if stop_on_error and "error" in item:
+                for j in range(i + 1, len(self.requests)):
+                    await self.finish(j, {"action": request_action(self.requests[j]),
+                                          "skipped": True})
+                return
+
+
+async def handle_batch(data, websocket, path=None):
+    """data: {requests: [{action, data}], parallel, stream, stopOnError}
+    Runs the requests one after another (or all at once with parallel: true)
+    and answers with {type: "batchResult", results: [...], errors}. Each
+    result is {index, action, result} with the (last) reply of the request,
+    earlier replies such as streamed output in "messages", and "error" if the
+    request failed (including evals with an error result). With stream: true
+    every result is sent as {type: "batchItem", ...} when it is ready, then
+    {type: "batchDone", count, errors}. With stopOnError the requests after a
+    failed one are skipped (sequential batches only)."""
+    requests = data.get("requests")
+    if not isinstance(requests, list):
+        return await send(websocket, {"error": "needs requests"})
+    batch = Batch(requests, websocket, path, data.get("stream"))
+    if data.get("parallel"):
+        await batch.run_parallel()
+    else:
+        await batch.run_sequential(data.get("stopOnError"))
+    if batch.stream:
+        return await send(websocket, {"type": "batchDone", "count": len(requests),
+                                      "errors": batch.errors})
+    await send(websocket, {"type": "batchResult", "results": batch.results, "errors": batch.errors})
+
+
+# action -> handler(data, websocket)
+handlers = {
+    "eval": handle_eval,
+    "cancel": handle_cancel,
+    "inspect": handle_inspect,
+    "completion": handle_completion,
+    "completion_details": handle_completion_details,
+    "code_format": handle_code_format,
+    "code_format_batch": handle_code_format_batch,
+    "batch": handle_batch,
+    "stats": handle_stats
+}
+
+# actions allowed in batches
+batch_actions = tuple(ea for ea in handlers if ea not in ("batch", "cancel"))
+
+
+async def handle_in_session(action, data, websocket):
+    worker = session_manager.acquire(connection_of(websocket))
+    async for reply in worker.replies(action, data):
+        await send(websocket, reply)
 
 
 async def handle_message(message, websocket, path):
-    """{action, data, target}"""
+    """{action, data, target, id}, replies to messages with id are sent as
+    {id, data: reply}"""
     action = message.get("action")
     data = message.get("data")
+    if message.get("id") is not None and not isinstance(websocket, Responder):
+        websocket = Responder(websocket, message.get("id"))
 
     if not action:
-        await websocket.send(json.dumps({"error": "message needs action"}))
+        await send(websocket, {"error": "message needs action"})
         return
 
-    if action == "eval":
-        return await handle_eval(data, websocket)
-    if action == "completion":
-        return await handle_completion(data, websocket)
-    if action == "code_format":
-        return await handle_code_format(data, websocket)
-
-    await websocket.send(json.dumps({"error": "message not understood {}".format(action)}))
+    if session_manager and action in session_actions:
+        return await handle_in_session(action, data, websocket)
+    handle = handlers.get(action)
+    if handle is None:
+        return await send(websocket, {"error": "message not understood {}".format(action)})
+    await handle(data, websocket)
 
 
 connections = set()
 
-async def handler(websocket, path):
-    if debug:
-        print("got connection")
+# actions counted under their name in lively.metrics, others as "other"
+known_actions = tuple(handlers)
+
+async def process_message(message, websocket, path):
+    try:
+        parsed = (wire.decode(message, codec_of(websocket))
+                  if isinstance(message, (str, bytes)) else message)
+    except Exception:
+        parsed = None
+    action = request_action(parsed)
+    # the Responder notes error replies, for the status in the metrics
+    websocket = Responder(websocket, parsed.get("id") if isinstance(parsed, dict) else None)
+    try:
+        with metrics.track(action if action in known_actions else "other") as request:
+            if parsed is None:
+                raise ValueError("message is not JSON: {}".format(str(message)[:100]))
+            await handle_message(parsed, websocket, path)
+            if websocket.failed:
+                request["status"] = "error"
+    except Exception:
+        err_str = traceback.format_exc()
+        logger.error("error in handle_message: %s", err_str)
+        await send(websocket, {"error": err_str})
+
+
+async def process_message_limited(message, websocket, path, limit, after=None):
+    """process_message once a slot of the semaphore limit is free and the task
+    after (if any) is done"""
+    if after:
+        await asyncio.wait([after])
+    async with limit:
+        await process_message(message, websocket, path)
+
+
+async def close_connection(websocket, tasks):
+    connections.remove(websocket)
+    release_registry(websocket)
+    metrics.connections.set(len(connections))
+    metrics.log_event(logger, "connection closed", connections=len(connections))
+    for task in tasks:
+        task.cancel()
+    if session_manager:
+        await asyncio.get_event_loop().run_in_executor(
+            None, session_manager.release, websocket)
+
+
+async def handler(websocket, path=None):
     connections.add(websocket)
+    metrics.connections.set(len(connections))
+    metrics.log_event(logger, "connection opened", connections=len(connections))
+
+    # the encoding of messages, see lively.wire
+    codec = websocket.lively_codec = wire.codec_for(getattr(websocket, "subprotocol", None))
 
     # allow client to send itself extra data
     websocket.send_raw_data = lambda data: websocket.send(data)
 
+    # Every message is handled in a task of its own, so that slow evals don't
+    # hold up completions or formatting on the same connection. Messages with
+    # an id can be answered in any order. Those without one are answered in
+    # the order they came in, each waits for the one before. At most
+    # max_concurrent_requests run at a time, except for cancel requests which
+    # are handled right away.
+    limit = asyncio.Semaphore(max_concurrent_requests)
+    tasks = set()
+    last_in_order = None
+
     while True:
+        if len(tasks) >= max_pending_requests:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
         try:
             message = await websocket.recv()
-        except websockets.exceptions.ConnectionClosed:
-            if debug:
-                print("connection closed")
-            connections.remove(websocket)
+        except ConnectionClosed:
+            await close_connection(websocket, tasks)
             break
-        # if debug: print("got " + message)
+        metrics.message_size.observe(encoded_size(message), direction="in")
         try:
-            parsed = json.loads(message)
-            await handle_message(parsed, websocket, path)
-        except Exception as err:
-            # err_str = json.dumps({"error": str(err)})
-            # err_str = json.dumps({"error": "\n".join(traceback.format_tb(err.__traceback__))})
-            err_str = json.dumps({"error": traceback.format_exc()})
-            print("error in handle_message: " + err_str)
-            await websocket.send(err_str)
+            message = wire.decode(message, codec)
+        except Exception:
+            pass  # reported by process_message
+        if isinstance(message, dict) and message.get("action") == "cancel":
+            await process_message(message, websocket, path)
             continue
+        in_order = not isinstance(message, dict) or message.get("id") is None
+        task = asyncio.ensure_future(process_message_limited(
+            message, websocket, path, limit, last_in_order if in_order else None))
+        if in_order:
+            last_in_order = task
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
 
 
 # -=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-=-
@@ -128,12 +541,39 @@ def fix_pager():
 
 def start(hostname=default_host,
           port=default_port,
-          loop=asyncio.get_event_loop()):
+          loop=asyncio.get_event_loop(),
+          sessions=None,
+          completion_modules=(),
+          metrics_port=None):
+    """sessions: optional lively.sessions.SessionManager to run the evals of each
+    connection in an isolated worker process. completion_modules are parsed by
+    jedi in the background so that the first completions on them are fast.
+    metrics_port: serve the Prometheus text of lively.metrics on
+    http://127.0.0.1:metrics_port/metrics"""
+    global session_manager
+    metrics.setup_logging(logger, debug)
+    if metrics_port:
+        metrics.serve_http(default_host, metrics_port)
+        metrics.log_event(logger, "metrics endpoint", level=logging.INFO, port=metrics_port)
+    if sessions:
+        session_manager = sessions.start()
+    if completion_modules:
+        # in the "completion" pool, jedi caches and state are shared with completions
+        loop.run_in_executor(executors.get_executor("completion"), prewarm_completions,
+                             list(completion_modules))
     fix_pager()
-    serve = websockets.serve(handler, hostname, port)
-    loop.run_until_complete(serve)
-    print("server listening on {}:{}".format(hostname, port))
-    return serve
+    extensions = [ServerPerMessageDeflateFactory(**compression)] if compression else None
+
+    # newer websockets versions need the loop running when serve is called
+    async def serve():
+        return await websockets.serve(handler, hostname, port,
+                                      subprotocols=list(wire.codecs),
+                                      select_subprotocol=select_subprotocol,
+                                      compression=None,
+                                      extensions=extensions)
+    server = loop.run_until_complete(serve())
+    metrics.log_event(logger, "server listening", level=logging.INFO, host=hostname, port=port)
+    return server
 
 def start_in_subprocess(**opts):
     def spawn():
@@ -141,7 +581,7 @@ def start_in_subprocess(**opts):
         asyncio.set_event_loop(loop)
         start(**{**opts, "loop": loop})
         loop.run_forever()
-    process = Process(target=spawn, kwargs=opts)
+    process = Process(target=spawn)
     process.start()
     return process
 
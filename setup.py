@@ -66,7 +66,9 @@ setup(
     # for example:
     # $ pip install -e .[dev,test]
     extras_require={
-        'dev': []
+        'dev': [],
+        # faster JSON encoding and the msgpack wire format, see lively/wire.py
+        'wire': ["orjson", "msgpack"]
     },
 
     # If there are data files included in your packages that need to be